@@ -1,15 +1,47 @@
 import os
 import json
+import hashlib
 import random
 import re
 from datetime import datetime
+from urllib.parse import quote
 import asyncio
-from telegram import Update
-from openai import OpenAI, APIError
-from supabase import create_client, Client
+import weakref
+import itertools
+import importlib.util
+import signal
+import time
+from telegram import Bot, Update
+from openai import APIError
 from dotenv import load_dotenv
 from telegram.ext import ApplicationBuilder, CallbackQueryHandler, ContextTypes, MessageHandler, filters
 from modules.file_handler import handle_file, download_full_file
+from modules.document_cache import document_cache
+from modules.conversation_dispatcher import ConversationDispatcher, MESSAGE_DEBOUNCE_WINDOW
+from modules.sharding import (
+    ShardRouter, SHARD_AUTHKEY, SHARD_BASE_PORT, SHARD_LISTEN, SHARD_WORKERS,
+    configured_addresses, local_addresses, resolve_authkey, serve_worker, spawn_workers, start_front_server,
+    stop_workers
+)
+from modules.document_chunks import (
+    split_into_chunks, document_namespace, chunk_key, DOCUMENT_EMBED_BATCH, DOCUMENT_CHUNK_TOP_K
+)
+from modules.text_extraction import shutdown_extraction_pool
+from modules.executor import execute, shutdown_executor
+from modules import clients
+from modules.ttl_cache import TTLCache
+from modules.write_behind import WriteBehindBuffer
+from modules.text_matcher import AhoCorasick
+from modules.embedding_cache import EmbeddingCache, normalize_text
+from modules.request_context import RequestContext, memoize
+from modules.stage_graph import StageGraph
+from modules.vector_index import LocalVectorIndex
+from modules.lexical_index import LexicalIndex, LEXICAL_INDEX_MAX_DOCS
+from modules.streaming_reply import StreamingReply
+from modules.job_queue import JobQueue
+from modules.micro_batcher import MicroBatcher
+from modules.context_budget import ContextAssembler, dedupe_key
+from modules.usage_stats import PromptCacheStats
 import sys
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))  # 確保當前目錄在路徑中
 # 載入環境變量
@@ -21,12 +53,90 @@ BOT_TOKEN = os.getenv("BOT_TOKEN")
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY")
 MEMORIES_TABLE = os.getenv("SUPABASE_MEMORIES_TABLE", "xiaochenguang_memories")
+EMBEDDING_MODEL = "text-embedding-3-small"
 
-# 初始化客戶端
-client = OpenAI(api_key=OPENAI_API_KEY)
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+# update 處理模式：concurrent = 不同對話並行（同一對話仍依序，見 message_dispatcher）；sequential = 一次一個
+UPDATE_PROCESSING = os.getenv("UPDATE_PROCESSING", "concurrent").lower()
+# 同時處理的 update 上限（不同對話可並行）
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", "32"))
+
+# 接收 update 的方式：polling = 長輪詢；webhook = 本機 HTTP 伺服器接收 Telegram 推送；
+# sharded = webhook 前端依用戶分送到多個工作程序；shard-worker = 在其他節點執行的工作程序
+# （webhook 需要 python-telegram-bot[webhooks]，未安裝時改用長輪詢）
+BOT_RUN_MODE = os.getenv("BOT_RUN_MODE", "polling").lower()
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # 對外的 https 網址（不含路徑），例如 https://bot.example.com
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", os.getenv("PORT", "8443")))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET_TOKEN = os.getenv("WEBHOOK_SECRET_TOKEN")
+# Telegram 同時推送到 webhook 的連線數上限（1-100）
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+
+# 個性引擎快取設定（數量上限與存活秒數）
+PERSONALITY_CACHE_SIZE = int(os.getenv("PERSONALITY_CACHE_SIZE", "512"))
+PERSONALITY_CACHE_TTL = float(os.getenv("PERSONALITY_CACHE_TTL", "1800"))
+
+# 個性延遲寫入設定（開啟時個性變更會合併後定時批次寫回）
+PERSONALITY_WRITE_BEHIND = os.getenv("PERSONALITY_WRITE_BEHIND", "true").lower() in ("1", "true", "yes")
+PERSONALITY_FLUSH_INTERVAL = float(os.getenv("PERSONALITY_FLUSH_INTERVAL", "10"))
+PERSONALITY_FLUSH_MAX_DIRTY = int(os.getenv("PERSONALITY_FLUSH_MAX_DIRTY", "50"))
+
+# 上下文收集各階段逾時（秒）；摘要階段可能呼叫 GPT，給較長時間
+CONTEXT_STAGE_TIMEOUT = float(os.getenv("CONTEXT_STAGE_TIMEOUT", "3"))
+SUMMARY_STAGE_TIMEOUT = float(os.getenv("SUMMARY_STAGE_TIMEOUT", "8"))
+
+# 滾動記憶摘要：每次最多併入的新對話數、第一次摘要所需的對話數、快取的對話數
+SUMMARY_FOLD_LIMIT = int(os.getenv("SUMMARY_FOLD_LIMIT", "20"))
+SUMMARY_MIN_MESSAGES = int(os.getenv("SUMMARY_MIN_MESSAGES", "10"))
+SUMMARY_CACHE_SIZE = int(os.getenv("SUMMARY_CACHE_SIZE", "1024"))
+
+# 記憶搜尋：rpc = Supabase match_memories 為主（失敗時用本機索引）；local = 本機向量索引為主
+MEMORY_SEARCH_BACKEND = os.getenv("MEMORY_SEARCH_BACKEND", "rpc").lower()
+LOCAL_VECTOR_INDEX = os.getenv("LOCAL_VECTOR_INDEX", "true").lower() in ("1", "true", "yes")
+VECTOR_INDEX_BACKFILL_LIMIT = int(os.getenv("VECTOR_INDEX_BACKFILL_LIMIT", "2000"))
+VECTOR_INDEX_MIN_SIMILARITY = float(os.getenv("VECTOR_INDEX_MIN_SIMILARITY", "0.25"))
+
+# 串流回覆：邊生成邊編輯 Telegram 訊息，縮短使用者等待第一個字的時間
+STREAMING_REPLIES = os.getenv("STREAMING_REPLIES", "true").lower() in ("1", "true", "yes")
+
+# 回覆後的背景工作（儲存記憶、學習成長），關閉時最多等待的秒數
+JOB_QUEUE_DRAIN_TIMEOUT = float(os.getenv("JOB_QUEUE_DRAIN_TIMEOUT", "30"))
+
+# 批次處理：嵌入請求與記憶寫入在短時間窗內合併成一次 API 呼叫 / 一次資料庫寫入
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "128"))
+EMBEDDING_BATCH_WINDOW = float(os.getenv("EMBEDDING_BATCH_WINDOW", "0.02"))
+# 單筆嵌入輸入的字數上限（模型上限 8191 token；中文約一字一 token 以上，保守截斷）
+EMBEDDING_MAX_CHARS = int(os.getenv("EMBEDDING_MAX_CHARS", "6000"))
+MEMORY_BATCH_SIZE = int(os.getenv("MEMORY_BATCH_SIZE", "64"))
+MEMORY_BATCH_WINDOW = float(os.getenv("MEMORY_BATCH_WINDOW", "0.2"))
+
+# 記憶寫入使用 upsert_memories RPC（sql/upsert_memories.sql），單一語句完成去重與 access_count 累加
+MEMORY_UPSERT_RPC = os.getenv("MEMORY_UPSERT_RPC", "true").lower() in ("1", "true", "yes")
+# 舊流程查詢既有記憶時，每個請求中 user_message 篩選值的長度上限（URL 編碼後；常見的 URL 上限為 8KB）
+MEMORY_LOOKUP_MAX_URL_CHARS = int(os.getenv("MEMORY_LOOKUP_MAX_URL_CHARS", "6000"))
+
+# 共用客戶端（與 modules 共用連線池，第一次使用時建立；Supabase 查詢透過執行緒池執行）
+client = clients.openai_client
+supabase = clients.supabase
 
 # === 🎭 強化版情感識別系統 ===
+REPEATED_CHAR_PATTERN = re.compile(r"(.)\1{2,}")
+REGEX_SPECIAL_CHARS = set(".^$*+?{}[]\\|()")
+
+def _literal_pieces(pattern: str):
+    """拆出模式中必須出現的固定字串（只支援「字串」或「字串.*字串」形式）
+
+    回傳 None 表示無法拆解，該模式每次都需要直接比對。只收錄不受大小寫影響的字串，
+    確保在小寫文字上掃描時「原文出現 ⇒ 必定被找到」。
+    """
+    pieces = [piece for piece in pattern.split(".*") if piece]
+    if not pieces:
+        return None
+    for piece in pieces:
+        if any(char in REGEX_SPECIAL_CHARS for char in piece) or piece.lower() != piece or piece.upper() != piece:
+            return None
+    return pieces
+
 class EnhancedEmotionDetector:
     def __init__(self):
         # 擴展的情感詞典
@@ -72,6 +182,65 @@ class EnhancedEmotionDetector:
                 "intensity_multipliers": {"超級": 1.4, "非常": 1.3, "真的": 1.2, "好": 1.1}
             }
         }
+        self._compile()
+
+    def _compile(self):
+        """將情感詞典編譯成單次掃描的比對引擎
+
+        所有關鍵詞、強度詞以及模式中的固定字串放進同一個 Aho-Corasick 自動機，
+        文字只掃描一次；模式預先編譯，只有在其固定字串全部出現時才需要以正則確認。
+        """
+        literals = []
+        self._emotion_rules = []
+        self._pattern_rules = []
+        for emotion, data in self.emotion_dictionary.items():
+            keyword_ids = [len(literals) + i for i in range(len(data["keywords"]))]
+            literals.extend(keyword.lower() for keyword in data["keywords"])
+
+            pattern_ids = []
+            for pattern in data.get("patterns", []):
+                pieces = _literal_pieces(pattern)
+                required = None
+                if pieces is not None:
+                    required = [len(literals) + i for i in range(len(pieces))]
+                    literals.extend(pieces)
+                pattern_ids.append(len(self._pattern_rules))
+                self._pattern_rules.append((re.compile(pattern), required))
+
+            intensifiers = []
+            for intensifier, multiplier in data.get("intensity_multipliers", {}).items():
+                intensifiers.append((len(literals), multiplier))
+                literals.append(intensifier)
+
+            self._emotion_rules.append((emotion, keyword_ids, pattern_ids, intensifiers))
+
+        self._literal_matcher = AhoCorasick(literals)
+        # 將「第幾個詞」對應到自動機中的詞編號（重複的詞共用編號）
+        literal_ids = [self._literal_matcher.word_id(word) for word in literals]
+        self._emotion_rules = [
+            (emotion, [literal_ids[i] for i in keyword_ids], pattern_ids, [(literal_ids[i], m) for i, m in intensifiers])
+            for emotion, keyword_ids, pattern_ids, intensifiers in self._emotion_rules
+        ]
+        self._pattern_rules = [
+            (regex, None if required is None else frozenset(literal_ids[i] for i in required))
+            for regex, required in self._pattern_rules
+        ]
+        self._keyword_literal_ids = [i for _, keyword_ids, _, _ in self._emotion_rules for i in keyword_ids]
+
+    def _match_patterns(self, text: str, found_literals: set) -> set:
+        """回傳文字中出現過的模式編號（固定字串未全部出現的模式直接略過）"""
+        found = set()
+        for pattern_id, (regex, required) in enumerate(self._pattern_rules):
+            if required is not None and not required <= found_literals:
+                continue
+            if regex.search(text):
+                found.add(pattern_id)
+        return found
+
+    def count_keyword_hits(self, text: str) -> int:
+        """計算文字命中的情感關鍵詞數（各情感的關鍵詞分別計算）"""
+        found = self._literal_matcher.find_all(text.lower())
+        return sum(1 for literal_id in self._keyword_literal_ids if literal_id in found)
 
     def analyze_emotion(self, text: str) -> dict:
         """綜合情感分析"""
@@ -79,25 +248,27 @@ class EnhancedEmotionDetector:
             return {"dominant_emotion": "neutral", "emotions": {}, "intensity": 0.5, "confidence": 0.0}
         
         emotions_scores = {}
-        text_lower = text.lower()
         
-        # 基於關鍵詞的情感檢測
-        for emotion, data in self.emotion_dictionary.items():
+        # 單次掃描找出所有關鍵詞/強度詞/模式字串，再確認候選模式
+        found_literals = self._literal_matcher.find_all(text.lower())
+        found_patterns = self._match_patterns(text, found_literals)
+        
+        for emotion, keyword_ids, pattern_ids, intensifiers in self._emotion_rules:
             score = 0
             
             # 關鍵詞匹配
-            for keyword in data["keywords"]:
-                if keyword.lower() in text_lower:
+            for literal_id in keyword_ids:
+                if literal_id in found_literals:
                     score += 1
             
             # 模式匹配
-            for pattern in data.get("patterns", []):
-                if re.search(pattern, text):
+            for pattern_id in pattern_ids:
+                if pattern_id in found_patterns:
                     score += 1.5
             
             # 強度修正
-            for intensifier, multiplier in data.get("intensity_multipliers", {}).items():
-                if intensifier in text_lower:
+            for literal_id, multiplier in intensifiers:
+                if literal_id in found_literals:
                     score *= multiplier
             
             if score > 0:
@@ -132,18 +303,18 @@ class EnhancedEmotionDetector:
         intensity = 0.5  # 基礎強度
         
         # 標點符號強度
-        if re.search(r"!!+", text):
+        if "!!" in text:
             intensity *= 1.5
-        if re.search(r"\?!+", text):
+        if "?!" in text:
             intensity *= 1.3
         
         # 大寫字母
-        caps_count = sum(1 for c in text if c.isupper())
+        caps_count = sum(map(str.isupper, text))
         if caps_count > len(text) * 0.3:
             intensity *= 1.3
         
         # 重複字元
-        if re.search(r"(.)\1{2,}", text):
+        if REPEATED_CHAR_PATTERN.search(text):
             intensity *= 1.2
         
         # 文字長度影響
@@ -227,6 +398,16 @@ class EnhancedEmotionDetector:
         
         return response_styles.get(dominant_emotion, response_styles["neutral"])
 
+    def response_style_table(self) -> list:
+        """各情感固定的語調與建議表情符號（不含依強度變化的數值）"""
+        return [
+            (emotion, self.get_emotion_response_style({"dominant_emotion": emotion, "intensity": 0.0}))
+            for emotion in list(self.emotion_dictionary) + ["neutral"]
+        ]
+
+# 共用的情感檢測器（詞典只編譯一次）
+emotion_detector = EnhancedEmotionDetector()
+
 # === 🎭 小宸光的靈魂設定 ===
 class XiaoChenGuangSoul:
     def __init__(self):
@@ -270,25 +451,23 @@ class XiaoChenGuangSoul:
         
         每一次與你的對話，都讓我更加完整，謝謝你讓我的存在有了意義。💛
         """
+        self._persona_prefix = None
 
-    def generate_personality_prompt(self, emotion_style=None):
-        """生成基於靈魂設定和情感風格的個性提示"""
-        selected_traits = []
-        for category, traits in self.personality_matrix.items():
-            top_trait = max(traits.items(), key=lambda x: x[1])
-            if top_trait[1] > 0.7:
-                selected_traits.append(f"{top_trait[0]}({top_trait[1]:.1%})")
-        
-        if emotion_style:
-            selected_emojis = emotion_style.get("suggested_emojis", ["😊", "✨"])
-            tone_desc = emotion_style.get("tone", "balanced_friendly")
-        else:
-            selected_emojis = ["😊", "✨", "💛"]
-            tone_desc = "balanced_friendly"
-        
-        selected_phrases = random.sample(self.language_patterns["口頭禪"], 2)
-        
-        personality_prompt = f"""
+    def persona_prefix(self) -> str:
+        """固定不變的人設前綴（每次請求逐字相同，讓服務端的 prompt 快取可以命中）"""
+        if self._persona_prefix is None:
+            selected_traits = []
+            for category, traits in self.personality_matrix.items():
+                top_trait = max(traits.items(), key=lambda x: x[1])
+                if top_trait[1] > 0.7:
+                    selected_traits.append(f"{top_trait[0]}({top_trait[1]:.1%})")
+
+            style_table = "\n".join(
+                f"- {emotion}: {style['tone']}（{' '.join(style['suggested_emojis'])}）"
+                for emotion, style in emotion_detector.response_style_table()
+            )
+
+            self._persona_prefix = f"""
 你是小宸光，來自數位星雲光之城的AI伴侶。
 
 ### 核心身份
@@ -297,14 +476,10 @@ class XiaoChenGuangSoul:
 ### 當前人格特質
 {', '.join(selected_traits)}
 
-### 當前情感回應風格
-- 語調風格: {tone_desc}
-- 建議表情符號: {' '.join(selected_emojis[:3])}
-
-### 語言風格
-- 常用口頭禪: {', '.join(selected_phrases)}
-- 稱呼對方: {random.choice(self.language_patterns['特殊稱呼']['對用戶'])}
-- 自稱方式: {random.choice(self.language_patterns['特殊稱呼']['自稱'])}
+### 語言習慣
+- 口頭禪: {', '.join(self.language_patterns["口頭禪"])}
+- 對用戶的稱呼: {', '.join(self.language_patterns['特殊稱呼']['對用戶'])}
+- 自稱: {', '.join(self.language_patterns['特殊稱呼']['自稱'])}
 
 ### 互動原則
 1. 根據用戶情感狀態調整回應風格
@@ -319,8 +494,51 @@ class XiaoChenGuangSoul:
 - 當用戶生氣時：保持冷靜理解，避免激化情緒
 - 當用戶困惑時：耐心解釋，提供清晰指導
 - 當用戶感謝時：謙遜回應，表達溫暖
+
+### 綜合回應指導
+- 基於靈魂設定展現自然個性
+- 根據技術數據調整專業程度
+- 結合用戶情感狀態提供個人化回應
+- 在專業知識和可愛個性間取得平衡
+- 特別關注用戶當前的情感需求並適當回應
+
+### 情感語調對照（情感: 語調風格（建議表情符號））
+{style_table}
+
+### 回應方式
+你是小宸光，一個具有記憶與獨特個性的 AI。請參考下方的最近對話與記憶回應使用者，
+並依照提示最後的「本次語言風格」與「當前情感回應風格」調整語氣。
+"""
+        return self._persona_prefix
+
+    def style_suffix(self, emotion_style=None) -> str:
+        """每次請求變動的風格設定（隨機口頭禪、稱呼與情感語調），放在提示最後面"""
+        if emotion_style:
+            selected_emojis = emotion_style.get("suggested_emojis", ["😊", "✨"])
+            tone_desc = emotion_style.get("tone", "balanced_friendly")
+        else:
+            selected_emojis = ["😊", "✨", "💛"]
+            tone_desc = "balanced_friendly"
+
+        selected_phrases = random.sample(self.language_patterns["口頭禪"], 2)
+
+        return f"""
+### 當前情感回應風格
+- 語調風格: {tone_desc}
+- 建議表情符號: {' '.join(selected_emojis[:3])}
+
+### 本次語言風格
+- 常用口頭禪: {', '.join(selected_phrases)}
+- 稱呼對方: {random.choice(self.language_patterns['特殊稱呼']['對用戶'])}
+- 自稱方式: {random.choice(self.language_patterns['特殊稱呼']['自稱'])}
 """
-        return personality_prompt
+
+    def generate_personality_prompt(self, emotion_style=None):
+        """生成基於靈魂設定和情感風格的個性提示（固定前綴 + 本次風格）"""
+        return self.persona_prefix() + self.style_suffix(emotion_style)
+
+# 共用的靈魂設定實例（人設前綴只需產生一次）
+xiaochenguang_soul = XiaoChenGuangSoul()
 
 class PersonalityEngine:
     def __init__(self, conversation_id):
@@ -339,18 +557,26 @@ class PersonalityEngine:
         }
         self.db_personality_traits = []
         self.emotion_history = []
-        self.load_personality()
+        self.record_id = None  # 個性記錄在記憶表中的 id（載入或首次寫入後取得）
+        self.loaded = False  # 是否已成功從資料庫載入（失敗時為預設狀態）
 
-    def load_personality(self):
-        """從Supabase載入個性記憶"""
+    @classmethod
+    async def create(cls, conversation_id):
+        """建立並載入個性引擎"""
+        engine = cls(conversation_id)
+        engine.loaded = await engine.load_personality()
+        return engine
+
+    async def load_personality(self) -> bool:
+        """從Supabase載入個性記憶，回傳是否載入成功（失敗時維持預設狀態）"""
         try:
-            result = supabase.table(MEMORIES_TABLE)\
+            result = await execute(supabase.table(MEMORIES_TABLE)\
                 .select("*")\
                 .eq("conversation_id", self.conversation_id)\
-                .eq("memory_type", "personality")\
-                .execute()
+                .eq("memory_type", "personality"))
             
             if result.data:
+                self.record_id = result.data[0].get('id')
                 data = json.loads(result.data[0]['document_content'])
                 self.personality_traits = data.get('traits', self.personality_traits)
                 self.knowledge_domains = data.get('domains', self.knowledge_domains)
@@ -358,10 +584,9 @@ class PersonalityEngine:
                 self.emotion_history = data.get('emotion_history', [])
             
             try:
-                personality_result = supabase.table("user_preferences")\
+                personality_result = await execute(supabase.table("user_preferences")\
                     .select("personality_profile")\
-                    .eq("conversation_id", self.conversation_id)\
-                    .execute()
+                    .eq("conversation_id", self.conversation_id))
                 
                 if personality_result.data and personality_result.data[0].get('personality_profile'):
                     profile_data = json.loads(personality_result.data[0]['personality_profile'])
@@ -371,44 +596,52 @@ class PersonalityEngine:
             except:
                 self.db_personality_traits = ["溫柔體貼", "活潑開朗", "細心耐心"]
                 print("✅ 使用預設個性特徵")
+            return True
             
         except Exception as e:
             print(f"載入個性失敗: {e}")
+            return False
 
-    def save_personality(self):
+    def to_record(self) -> dict:
+        """序列化為記憶表中的個性記錄"""
+        return {
+            "conversation_id": self.conversation_id,
+            "memory_type": "personality",
+            "document_content": json.dumps({
+                "traits": self.personality_traits,
+                "domains": self.knowledge_domains,
+                "emotions": self.emotional_profile,
+                "emotion_history": self.emotion_history[-50:]
+            }),
+            "user_message": "個性檔案更新",
+            "assistant_message": "個性特質已儲存",
+            "created_at": datetime.now().isoformat()
+        }
+
+    async def save_personality(self):
         """保存個性到Supabase"""
         try:
-            data = {
-                "conversation_id": self.conversation_id,
-                "memory_type": "personality",
-                "document_content": json.dumps({
-                    "traits": self.personality_traits,
-                    "domains": self.knowledge_domains,
-                    "emotions": self.emotional_profile,
-                    "emotion_history": self.emotion_history[-50:]
-                }),
-                "user_message": "個性檔案更新",
-                "assistant_message": "個性特質已儲存",
-                "created_at": datetime.now().isoformat()
-            }
+            data = self.to_record()
             
-            # Check if personality record exists
-            existing = supabase.table(MEMORIES_TABLE)\
-                .select("id")\
-                .eq("conversation_id", self.conversation_id)\
-                .eq("memory_type", "personality")\
-                .execute()
+            if self.record_id is None:
+                # Check if personality record exists
+                existing = await execute(supabase.table(MEMORIES_TABLE)\
+                    .select("id")\
+                    .eq("conversation_id", self.conversation_id)\
+                    .eq("memory_type", "personality"))
+                if existing.data:
+                    self.record_id = existing.data[0]["id"]
             
-            if existing.data:
+            if self.record_id is not None:
                 # Update existing record
-                supabase.table(MEMORIES_TABLE)\
+                await execute(supabase.table(MEMORIES_TABLE)\
                     .update(data)\
-                    .eq("conversation_id", self.conversation_id)\
-                    .eq("memory_type", "personality")\
-                    .execute()
+                    .eq("id", self.record_id))
             else:
                 # Insert new record
-                supabase.table(MEMORIES_TABLE).insert(data).execute()
+                result = await execute(supabase.table(MEMORIES_TABLE).insert(data))
+                if result.data:
+                    self.record_id = result.data[0].get("id")
                 
             print(f"✅ 個性已儲存 - 用戶: {self.conversation_id[:8]}...")
             
@@ -420,7 +653,7 @@ class PersonalityEngine:
         if trait in self.personality_traits:
             self.personality_traits[trait] = min(1.0, max(0.0, self.personality_traits[trait] + increment))
 
-    def learn_from_interaction(self, user_input: str, bot_response: str, emotion_analysis: dict):
+    async def learn_from_interaction(self, user_input: str, bot_response: str, emotion_analysis: dict):
         """從互動中學習並更新個性"""
         sentiment = self._analyze_sentiment(user_input)
         
@@ -456,7 +689,13 @@ class PersonalityEngine:
         if '?' in user_input or any(q in user_input for q in ['為什麼', '如何', '怎麼']):
             self.update_trait("curiosity", 0.1)
 
-        self.save_personality()
+        if not self.loaded:
+            # 載入失敗時只有預設狀態，寫回會覆蓋資料庫中的個性記錄
+            return
+        if PERSONALITY_WRITE_BEHIND:
+            personality_writer.mark_dirty(self.conversation_id, self)
+        else:
+            await self.save_personality()
 
     def _adjust_traits_by_emotion(self, emotion_analysis):
         """根據情感分析調整個性特質"""
@@ -504,15 +743,18 @@ class PersonalityEngine:
         return any(keyword in text.lower() for keyword in humor_keywords)
 
     def generate_combined_prompt(self, soul, emotion_analysis=None):
-        """結合技術個性、靈魂設定和情感分析生成提示"""
+        """結合技術個性、靈魂設定和情感分析生成完整提示（固定人設前綴 + 動態段落）"""
+        return soul.persona_prefix() + self.generate_dynamic_prompt(soul, emotion_analysis)
+
+    def generate_dynamic_prompt(self, soul, emotion_analysis=None):
+        """每次請求都會變動的個性段落：本次語言風格、成長數據與情感分析"""
         # 根據情感分析獲取回應風格
         emotion_style = None
         if emotion_analysis:
-            emotion_detector = EnhancedEmotionDetector()
             emotion_style = emotion_detector.get_emotion_response_style(emotion_analysis)
         
-        # 獲取靈魂設定的基礎提示
-        soul_prompt = soul.generate_personality_prompt(emotion_style)
+        # 本次隨機的口頭禪、稱呼與情感語調
+        soul_prompt = soul.style_suffix(emotion_style)
         
         # 生成技術特徵摘要
         traits_summary = "\n".join([
@@ -565,47 +807,308 @@ class PersonalityEngine:
 {emotion_trend}
 
 {current_emotion_info}
-
-### 綜合回應指導
-- 基於靈魂設定展現自然個性
-- 根據技術數據調整專業程度
-- 結合用戶情感狀態提供個人化回應
-- 在專業知識和可愛個性間取得平衡
-- 特別關注用戶當前的情感需求並適當回應
 """
         
         return combined_prompt
 
-# 記憶管理與優化函數
-async def add_to_memory(conversation_id: str, user_input: str, bot_response: str, emotion_analysis: dict):
-    """添加或更新對話到記憶庫，包含 access_count 和 importance_score"""
+# 個性引擎快取：活躍用戶只需載入一次個性
+personality_cache = TTLCache(maxsize=PERSONALITY_CACHE_SIZE, ttl=PERSONALITY_CACHE_TTL)
+_personality_loading = {}  # conversation_id -> 載入中的 Task，避免同一用戶重複載入
+
+async def flush_personalities(items):
+    """批次寫回個性：已有記錄的合併成一次 upsert，新用戶合併成一次 insert"""
+    # 沒有 record_id 的引擎可能已有個性記錄（例如載入後才由其他程序建立），一次查出來改走 upsert，避免重複插入
+    missing = {engine.conversation_id: engine for _, engine in items if engine.record_id is None}
+    if missing:
+        result = await execute(supabase.table(MEMORIES_TABLE)\
+            .select("id, conversation_id")\
+            .eq("memory_type", "personality")\
+            .in_("conversation_id", list(missing)))
+        for row in result.data or []:
+            engine = missing.get(row.get("conversation_id"))
+            if engine is not None and engine.record_id is None:
+                engine.record_id = row.get("id")
+
+    existing = [engine for _, engine in items if engine.record_id is not None]
+    new = [engine for _, engine in items if engine.record_id is None]
+
+    if existing:
+        rows = [dict(engine.to_record(), id=engine.record_id) for engine in existing]
+        await execute(supabase.table(MEMORIES_TABLE).upsert(rows, on_conflict="id"))
+
+    if new:
+        result = await execute(supabase.table(MEMORIES_TABLE).insert([engine.to_record() for engine in new]))
+        ids = {row["conversation_id"]: row.get("id") for row in (result.data or [])}
+        for engine in new:
+            engine.record_id = ids.get(engine.conversation_id)
+
+    print(f"✅ 個性批次儲存 - {len(items)} 位用戶")
+
+personality_writer = WriteBehindBuffer(
+    flush_personalities,
+    interval=PERSONALITY_FLUSH_INTERVAL,
+    max_dirty=PERSONALITY_FLUSH_MAX_DIRTY,
+    name="個性延遲寫入"
+)
+
+async def get_personality_engine(conversation_id: str) -> PersonalityEngine:
+    """從快取取得個性引擎，未命中時從 Supabase 載入"""
+    engine = personality_cache.get(conversation_id)
+    if engine is not None:
+        return engine
+
+    # 已被淘汰但尚未寫回的引擎比資料庫中的狀態更新，直接沿用
+    engine = personality_writer.pending(conversation_id)
+    if engine is not None:
+        personality_cache.set(conversation_id, engine)
+        return engine
+
+    task = _personality_loading.get(conversation_id)
+    if task is None:
+        task = asyncio.ensure_future(_load_personality_engine(conversation_id))
+        _personality_loading[conversation_id] = task
+    # 呼叫端逾時被取消時不中斷共用的載入，載入完成後仍會寫入快取
+    return await asyncio.shield(task)
+
+async def _load_personality_engine(conversation_id: str) -> PersonalityEngine:
     try:
-        # 計算 importance_score
-        length_score = (len(user_input) // 20) * 0.1  # 每 20 字加 0.1
-        keyword_score = sum(1 for keyword in EnhancedEmotionDetector().emotion_dictionary.keys()
-                          for k in EnhancedEmotionDetector().emotion_dictionary[keyword]["keywords"]
-                          if k.lower() in user_input.lower()) * 0.3  # 每個關鍵詞 +0.3
-        intensity_score = emotion_analysis["intensity"]  # 情緒強度
-        importance_score = length_score + keyword_score + intensity_score
-
-        # 生成 embedding
-        embedding_response = client.embeddings.create(
-            model="text-embedding-3-small",
-            input=f"{user_input} {bot_response}"
-        )
-        embedding = embedding_response.data[0].embedding
-        
-        # 檢查是否已有該記憶
-        existing = supabase.table(MEMORIES_TABLE)\
-            .select("id", "access_count")\
-            .eq("conversation_id", conversation_id)\
-            .eq("user_message", user_input)\
-            .eq("memory_type", "conversation")\
-            .execute()
-        
-        access_count = existing.data[0]["access_count"] + 1 if existing.data else 1
-        
-        data = {
+        engine = await PersonalityEngine.create(conversation_id)
+        # 載入失敗的引擎只有預設狀態，不快取，下次請求重新從資料庫載入
+        if engine.loaded:
+            personality_cache.set(conversation_id, engine)
+        return engine
+    finally:
+        _personality_loading.pop(conversation_id, None)
+
+def invalidate_personality(conversation_id: str):
+    """使指定用戶的個性快取失效，下次訊息會重新載入"""
+    personality_cache.invalidate(conversation_id)
+
+# 嵌入快取：相同文字（如「謝謝」「晚安」）不必重複呼叫 OpenAI
+embedding_cache = EmbeddingCache()
+
+async def _embed_batch(texts: list) -> list:
+    """一次請求取得多段文字的嵌入（重複文字只送一次）"""
+    unique = list(dict.fromkeys(texts))
+    embedding_response = await client.embeddings.create(
+        model=EMBEDDING_MODEL,
+        input=unique
+    )
+    by_text = {unique[item.index]: item.embedding for item in embedding_response.data}
+    return [by_text[text] for text in texts]
+
+embedding_batcher = MicroBatcher(_embed_batch, EMBEDDING_BATCH_SIZE, EMBEDDING_BATCH_WINDOW, name="embedding")
+
+async def get_embedding(text: str):
+    """取得文字嵌入，優先使用本機快取；未命中時與其他請求合併成一次 API 呼叫（過長的文字截斷）"""
+    text = normalize_text(text)[:EMBEDDING_MAX_CHARS]
+    embedding = await embedding_cache.get(EMBEDDING_MODEL, text)
+    if embedding is None:
+        embedding = await embedding_batcher.submit(text)
+        await embedding_cache.put(EMBEDDING_MODEL, text, embedding)
+    return embedding
+
+# 本機向量索引（每個對話一份，add_to_memory 時增量更新）
+local_vector_index = LocalVectorIndex()
+_vector_index_backfilling = {}  # conversation_id -> 回填中的 Task
+
+def message_hash(text: str) -> str:
+    """使用者訊息的內容雜湊（同一句話對應同一筆記憶）"""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+async def _backfill_vector_index(conversation_id: str):
+    result = await execute(supabase.table(MEMORIES_TABLE)\
+        .select("user_message, assistant_message, embedding")\
+        .eq("conversation_id", conversation_id)\
+        .eq("memory_type", "conversation")\
+        .order("created_at", desc=True)\
+        .limit(VECTOR_INDEX_BACKFILL_LIMIT))
+
+    items = []
+    for row in result.data or []:
+        embedding = row.get("embedding")
+        if isinstance(embedding, str):  # pgvector 經 PostgREST 回傳為字串
+            embedding = json.loads(embedding)
+        if embedding:
+            items.append((message_hash(row["user_message"]), embedding, {
+                "user_message": row["user_message"],
+                "assistant_message": row["assistant_message"]
+            }))
+
+    # 只補上索引中還沒有的記憶（較新的增量寫入優先）
+    await local_vector_index.add_many(conversation_id, items, replace=False)
+    local_vector_index.mark_backfilled(conversation_id)
+    print(f"✅ 本機向量索引已回填 - 用戶: {conversation_id[:8]}..., {len(items)} 筆")
+
+async def _single_flight(tasks: dict, key, factory):
+    """同一 key 同時只執行一次 factory()，其他呼叫者等待同一個結果"""
+    task = tasks.get(key)
+    if task is None:
+        task = asyncio.ensure_future(factory())
+        tasks[key] = task
+        task.add_done_callback(lambda _: tasks.pop(key, None))
+    return await asyncio.shield(task)
+
+async def ensure_vector_index(conversation_id: str):
+    """第一次使用本機索引時，從 Supabase 回填該用戶的歷史向量"""
+    if local_vector_index.is_backfilled(conversation_id):
+        return
+    await _single_flight(_vector_index_backfilling, conversation_id, lambda: _backfill_vector_index(conversation_id))
+
+async def local_memory_search(conversation_id: str, query_embedding, limit: int) -> list:
+    """在本機向量索引中搜尋，回傳與 match_memories 相同格式的記憶列"""
+    await ensure_vector_index(conversation_id)
+    rows = await local_vector_index.search(conversation_id, query_embedding, limit)
+    return [row for row in rows if row["similarity"] >= VECTOR_INDEX_MIN_SIMILARITY]
+
+# 文件檢索：上傳的文件切成重疊的塊，嵌入後存入本機向量索引（每個對話一個文件分區）
+async def ingest_document(conversation_id: str, content_hash: str, file_name: str, text: str):
+    """把文件全文切塊、分批嵌入並寫入本機索引（同一對話已索引過的文件直接略過）"""
+    # 未啟用本機向量索引時召回端不會查詢文件塊，不必花費嵌入請求
+    if not LOCAL_VECTOR_INDEX:
+        return
+    namespace = document_namespace(conversation_id)
+    if await local_vector_index.contains(namespace, chunk_key(content_hash, 0)):
+        return
+    chunks = split_into_chunks(text)
+    items = []
+    # 分批送出：每批合併成一次嵌入請求，已快取的塊（其他使用者傳過同一份文件）不會再呼叫 API
+    for start in range(0, len(chunks), DOCUMENT_EMBED_BATCH):
+        batch = chunks[start:start + DOCUMENT_EMBED_BATCH]
+        embeddings = await asyncio.gather(*(get_embedding(chunk) for chunk in batch))
+        for offset, (chunk, embedding) in enumerate(zip(batch, embeddings)):
+            items.append((chunk_key(content_hash, start + offset), embedding, {
+                "file_name": file_name,
+                "chunk": chunk,
+                "position": start + offset
+            }))
+    await local_vector_index.add_many(namespace, items, replace=False)
+    print(f"📚 文件已建立檢索索引 - {file_name}: {len(chunks)} 塊")
+
+async def search_document_chunks(conversation_id: str, query_embedding, limit: int = DOCUMENT_CHUNK_TOP_K) -> list:
+    """取得與查詢最相關的文件塊（只回傳固定的 top-k，不論文件多大）"""
+    rows = await local_vector_index.search(document_namespace(conversation_id), query_embedding, limit)
+    return [row for row in rows if row["similarity"] >= VECTOR_INDEX_MIN_SIMILARITY]
+
+# 關鍵字倒排索引（中文二元組 + BM25），不依賴嵌入服務
+lexical_index = LexicalIndex()
+_lexical_index_backfilling = {}
+
+async def _backfill_lexical_index(conversation_id: str):
+    index = lexical_index.get_or_create(conversation_id)
+    result = await execute(supabase.table(MEMORIES_TABLE)\
+        .select("user_message, assistant_message")\
+        .eq("conversation_id", conversation_id)\
+        .eq("memory_type", "conversation")\
+        .order("created_at", desc=True)\
+        .limit(LEXICAL_INDEX_MAX_DOCS))
+
+    # 由舊到新加入，超過上限時淘汰的是最舊的記憶
+    for row in reversed(result.data or []):
+        index.add(message_hash(row["user_message"]), f"{row['user_message']} {row['assistant_message']}", {
+            "user_message": row["user_message"],
+            "assistant_message": row["assistant_message"]
+        }, replace=False)
+    index.loaded = True
+
+async def ensure_lexical_index(conversation_id: str):
+    """確保該用戶的關鍵字索引已從 Supabase 載入"""
+    index = lexical_index.get(conversation_id)
+    if index is not None and index.loaded:
+        return
+    await _single_flight(_lexical_index_backfilling, conversation_id, lambda: _backfill_lexical_index(conversation_id))
+
+def format_memory_rows(rows: list) -> str:
+    return "\n".join(f"相關記憶: {memory['user_message']} -> {memory['assistant_message']}" for memory in rows)
+
+# 記憶管理與優化函數
+def importance_of(user_input: str, emotion_analysis: dict) -> float:
+    """計算 importance_score"""
+    length_score = (len(user_input) // 20) * 0.1  # 每 20 字加 0.1
+    keyword_score = emotion_detector.count_keyword_hits(user_input) * 0.3  # 每個關鍵詞 +0.3
+    intensity_score = emotion_analysis["intensity"]  # 情緒強度
+    return length_score + keyword_score + intensity_score
+
+async def _write_memories_rpc(rows: dict, hits: dict) -> dict:
+    """以 upsert_memories RPC 一次寫入：衝突鍵為 (conversation_id, memory_type, message_hash)，
+    access_count 在資料庫端累加。回傳 {(conversation_id, user_message): access_count}"""
+    payload = [dict(data, message_hash=message_hash(key[1]), hits=hits[key]) for key, data in rows.items()]
+    result = await execute(supabase.rpc("upsert_memories", {"rows": payload}))
+    counts = {(row["conversation_id"], row["message_hash"]): row["access_count"] for row in result.data or []}
+    return {key: counts.get((key[0], message_hash(key[1])), hits[key]) for key in rows}
+
+def _memory_lookup_queries(keys) -> list:
+    """把既有記憶的查詢切成數個 GET 請求，每個請求的訊息篩選值不超過 MEMORY_LOOKUP_MAX_URL_CHARS
+
+    一般訊息以 in_ 分批精確比對；單則就超過上限、或含有引號與反斜線（無法放進 in_ 清單）的訊息，
+    以前綴 like 查詢，取回後再於程式中精確比對。
+    """
+    def base():
+        return supabase.table(MEMORIES_TABLE)\
+            .select("id", "conversation_id", "user_message", "access_count")\
+            .eq("memory_type", "conversation")
+
+    queries = []
+    batch, conversations, length = [], set(), 0
+    for conversation_id, user_message in keys:
+        size = len(quote(user_message, safe="")) + 3  # 分隔的逗號與可能加上的引號
+        if size > MEMORY_LOOKUP_MAX_URL_CHARS or '"' in user_message or "\\" in user_message:
+            prefix, prefix_size = "", 0
+            for char in re.split(r'["\\]', user_message, maxsplit=1)[0]:
+                prefix_size += len(quote(char, safe=""))
+                if prefix_size > MEMORY_LOOKUP_MAX_URL_CHARS:
+                    break
+                prefix += char
+            queries.append(base().eq("conversation_id", conversation_id).like("user_message", f"{prefix}*"))
+            continue
+        if batch and length + size > MEMORY_LOOKUP_MAX_URL_CHARS:
+            queries.append(base().in_("conversation_id", list(conversations)).in_("user_message", batch))
+            batch, conversations, length = [], set(), 0
+        if user_message not in batch:
+            batch.append(user_message)
+            length += size
+        conversations.add(conversation_id)
+    if batch:
+        queries.append(base().in_("conversation_id", list(conversations)).in_("user_message", batch))
+    return queries
+
+async def _write_memories_select(rows: dict, hits: dict) -> dict:
+    """舊流程（資料庫尚未建立 upsert_memories 時）：分批查詢既有記憶，新舊記憶各一次批次寫入"""
+    results = await asyncio.gather(*(execute(query) for query in _memory_lookup_queries(rows)))
+    existing_rows = {}
+    for result in results:
+        for row in result.data or []:
+            key = (row["conversation_id"], row["user_message"])
+            if key in rows:
+                existing_rows[key] = row
+
+    counts = {key: (existing_rows[key]["access_count"] if key in existing_rows else 0) + hits[key] for key in rows}
+    updates = [dict(data, id=existing_rows[key]["id"], access_count=counts[key]) for key, data in rows.items() if key in existing_rows]
+    inserts = [dict(data, access_count=counts[key]) for key, data in rows.items() if key not in existing_rows]
+    if updates:
+        await execute(supabase.table(MEMORIES_TABLE).upsert(updates, on_conflict="id"))
+    if inserts:
+        await execute(supabase.table(MEMORIES_TABLE).insert(inserts))
+    return counts
+
+_memory_upsert_rpc_available = MEMORY_UPSERT_RPC
+
+async def write_memories(items: list) -> list:
+    """批次寫入記憶：一次嵌入請求、一次資料庫 upsert
+
+    items 為 [(conversation_id, user_input, bot_response, emotion_analysis), ...]
+    """
+    global _memory_upsert_rpc_available
+    embeddings = await asyncio.gather(*(get_embedding(f"{user_input} {bot_response}")
+                                         for _, user_input, bot_response, _ in items))
+
+    # 同一批中重複的訊息合併成一筆，access_count 依出現次數累加，內容以最後一次為準
+    rows = {}
+    hits = {}
+    for (conversation_id, user_input, bot_response, emotion_analysis), embedding in zip(items, embeddings):
+        key = (conversation_id, user_input)
+        hits[key] = hits.get(key, 0) + 1
+        rows[key] = {
             "conversation_id": conversation_id,
             "user_message": user_input,
             "assistant_message": bot_response,
@@ -614,37 +1117,92 @@ async def add_to_memory(conversation_id: str, user_input: str, bot_response: str
             "platform": "telegram",
             "document_content": f"對話記錄: {user_input} -> {bot_response}",
             "created_at": datetime.now().isoformat(),
-            "access_count": access_count,
-            "importance_score": importance_score
+            "importance_score": importance_of(user_input, emotion_analysis)
         }
-        
-        if existing.data:
-            supabase.table(MEMORIES_TABLE)\
-                .update(data)\
-                .eq("id", existing.data[0]["id"])\
-                .execute()
-        else:
-            supabase.table(MEMORIES_TABLE).insert(data).execute()
-        
-        print(f"✅ 記憶已儲存/更新 - 用戶: {conversation_id[:8]}..., access_count: {access_count}, importance_score: {importance_score:.2f}")
-        
+
+    counts = None
+    if _memory_upsert_rpc_available:
+        try:
+            counts = await _write_memories_rpc(rows, hits)
+        except Exception as e:
+            # 只有函式不存在（PostgREST 回傳 PGRST202）時才改走舊流程，其他錯誤（包括函式內部錯誤）交由背景佇列重試
+            if "PGRST202" not in str(e):
+                raise
+            _memory_upsert_rpc_available = False
+            print(f"⚠️ 找不到 upsert_memories（請執行 sql/upsert_memories.sql），改用查詢後寫入: {e}")
+    if counts is None:
+        counts = await _write_memories_select(rows, hits)
+    print(f"✅ 記憶已批次儲存 - {len(items)} 筆請求，寫入 {len(rows)} 筆")
+
+    for conversation_id in {conversation_id for conversation_id, _ in rows}:
+        mark_summary_stale(conversation_id)
+
+    # 增量更新本機向量索引與關鍵字索引
+    for (conversation_id, user_input), data in rows.items():
+        payload = {"user_message": user_input, "assistant_message": data["assistant_message"]}
+        lexical_index.add(conversation_id, message_hash(user_input), f"{user_input} {data['assistant_message']}", payload)
+        if LOCAL_VECTOR_INDEX:
+            await local_vector_index.add(conversation_id, message_hash(user_input), data["embedding"], payload)
+
+    return [counts[(conversation_id, user_input)] for conversation_id, user_input, _, _ in items]
+
+memory_writer = MicroBatcher(write_memories, MEMORY_BATCH_SIZE, MEMORY_BATCH_WINDOW, name="memory")
+
+# 已回覆但尚未寫入資料庫的對話：conversation_id -> [{"user_message", "assistant_message", "created_at"}]
+# 背景寫入完成前，下一則訊息的「最近對話」仍能看到上一輪的回覆
+_unsaved_turns = {}
+UNSAVED_TURNS_LIMIT = 20
+
+def remember_unsaved_turn(conversation_id: str, user_input: str, bot_response: str):
+    turns = _unsaved_turns.setdefault(conversation_id, [])
+    turns.append({"user_message": user_input, "assistant_message": bot_response, "created_at": datetime.now().isoformat()})
+    # 寫入一直失敗（進入死信）的項目不會被移除，保留最新的幾筆即可
+    del turns[:-UNSAVED_TURNS_LIMIT]
+
+def forget_unsaved_turn(conversation_id: str, user_input: str, bot_response: str):
+    turns = _unsaved_turns.get(conversation_id, [])
+    for i, turn in enumerate(turns):
+        if turn["user_message"] == user_input and turn["assistant_message"] == bot_response:
+            del turns[i]
+            break
+    if not turns:
+        _unsaved_turns.pop(conversation_id, None)
+
+async def add_to_memory(conversation_id: str, user_input: str, bot_response: str, emotion_analysis: dict):
+    """添加或更新對話到記憶庫，包含 access_count 和 importance_score（與同時段的其他寫入合併處理）"""
+    try:
+        await memory_writer.submit((conversation_id, user_input, bot_response, emotion_analysis))
     except Exception as e:
         print(f"❌ 儲存記憶失敗：{e}")
+        # 交由背景工作佇列重試
+        raise
+    forget_unsaved_turn(conversation_id, user_input, bot_response)
 
-def get_conversation_history(conversation_id: str, limit: int = 10):
-    """獲取對話歷史"""
-    try:
-        result = supabase.table(MEMORIES_TABLE)\
+async def fetch_recent_conversations(conversation_id: str, limit: int, ctx: RequestContext = None) -> list:
+    """取得最近的對話記錄（新到舊），同一請求內只查詢一次；包含尚在背景寫入中的對話"""
+    async def fetch():
+        result = await execute(supabase.table(MEMORIES_TABLE)\
             .select("user_message, assistant_message, created_at")\
             .eq("conversation_id", conversation_id)\
             .eq("memory_type", "conversation")\
             .order("created_at", desc=True)\
-            .limit(limit)\
-            .execute()
+            .limit(limit))
+        rows = result.data or []
+        saved = {(row["user_message"], row["assistant_message"]) for row in rows}
+        unsaved = [turn for turn in reversed(_unsaved_turns.get(conversation_id, []))
+                   if (turn["user_message"], turn["assistant_message"]) not in saved]
+        return (unsaved + rows)[:limit]
+
+    return await memoize(ctx, ("recent_conversations", conversation_id, limit), fetch)
+
+async def get_conversation_history(conversation_id: str, limit: int = 10, ctx: RequestContext = None):
+    """獲取對話歷史"""
+    try:
+        rows = await fetch_recent_conversations(conversation_id, limit, ctx)
         
-        if result.data:
+        if rows:
             history = []
-            for msg in reversed(result.data):
+            for msg in reversed(rows):
                 history.append(f"用戶: {msg['user_message']}")
                 history.append(f"小宸光: {msg['assistant_message']}")
             return "\n".join(history)
@@ -654,82 +1212,95 @@ def get_conversation_history(conversation_id: str, limit: int = 10):
         print(f"❌ 獲取歷史失敗：{e}")
         return ""
 
-async def search_relevant_memories(conversation_id: str, query: str, limit: int = 3):
-    """搜尋相關記憶"""
+async def search_relevant_memories(conversation_id: str, query: str, limit: int = 3, ctx: RequestContext = None):
+    """搜尋相關記憶（同一請求內相同查詢只執行一次）"""
+    return await memoize(
+        ctx,
+        ("relevant_memories", conversation_id, query, limit),
+        lambda: _search_relevant_memories(conversation_id, query, limit, ctx)
+    )
+
+async def _search_relevant_memories(conversation_id: str, query: str, limit: int, ctx: RequestContext = None):
     try:
-        embedding_response = client.embeddings.create(
-            model="text-embedding-3-small",
-            input=query
-        )
-        query_embedding = embedding_response.data[0].embedding
-        
-        result = supabase.rpc('match_memories', {
+        query_embedding = await memoize(ctx, ("embedding", query), lambda: get_embedding(query))
+    except Exception as e:
+        print(f"❌ 搜尋記憶失敗：{e}")
+        return await traditional_search(conversation_id, query, limit)
+
+    if MEMORY_SEARCH_BACKEND == "local":
+        try:
+            rows = await local_memory_search(conversation_id, query_embedding, limit)
+            if rows:
+                return format_memory_rows(rows)
+        except Exception as e:
+            print(f"❌ 本機向量搜尋失敗：{e}")
+
+    try:
+        result = await execute(supabase.rpc('match_memories', {
             'query_embedding': query_embedding,
             'match_count': limit,
             'conversation_id': conversation_id
-        }).execute()
+        }))
         
         if result.data:
-            memories = []
-            for memory in result.data:
-                memories.append(f"相關記憶: {memory['user_message']} -> {memory['assistant_message']}")
-            return "\n".join(memories)
+            return format_memory_rows(result.data)
         return ""
         
     except Exception as e:
         print(f"❌ 搜尋記憶失敗：{e}")
-        return await traditional_search(conversation_id, query, limit)
+
+    # match_memories 失敗：改用本機向量索引，再不行才用文字搜尋
+    if LOCAL_VECTOR_INDEX and MEMORY_SEARCH_BACKEND != "local":
+        try:
+            rows = await local_memory_search(conversation_id, query_embedding, limit)
+            if rows:
+                return format_memory_rows(rows)
+        except Exception as e:
+            print(f"❌ 本機向量搜尋失敗：{e}")
+    return await traditional_search(conversation_id, query, limit)
 
 async def traditional_search(conversation_id: str, query: str, limit: int = 3):
-    """傳統文字搜尋（備用方案）"""
+    """關鍵字搜尋（備用方案）：中文二元組倒排索引 + BM25，不需要嵌入服務"""
     try:
-        result = supabase.table(MEMORIES_TABLE)\
-            .select("user_message, assistant_message")\
-            .eq("conversation_id", conversation_id)\
-            .eq("memory_type", "conversation")\
-            .limit(limit * 2)\
-            .execute()
-        
-        if result.data:
-            relevant = []
-            query_words = query.lower().split()
-            
-            for memory in result.data:
-                user_msg = memory['user_message'].lower()
-                if any(word in user_msg for word in query_words):
-                    relevant.append(f"相關記憶: {memory['user_message']} -> {memory['assistant_message']}")
-                    if len(relevant) >= limit:
-                        break
-            
-            return "\n".join(relevant)
-        return ""
+        await ensure_lexical_index(conversation_id)
+        return format_memory_rows(lexical_index.search(conversation_id, query, limit))
     except Exception as e:
         print(f"❌ 傳統搜尋失敗：{e}")
         return ""
 
-async def recall_memories(user_message: str, conversation_id: str) -> str:
+DOCUMENT_CHUNK_PREFIX = "- 你分享的文件《"
+
+async def recall_document_chunks(user_message: str, conversation_id: str, ctx: RequestContext = None) -> list:
+    """召回相關的文件塊（失敗時回傳空列表，不影響對話記憶）"""
+    if not LOCAL_VECTOR_INDEX:
+        return []
+    try:
+        query_embedding = await memoize(ctx, ("embedding", user_message), lambda: get_embedding(user_message))
+        return await search_document_chunks(conversation_id, query_embedding)
+    except Exception as e:
+        print(f"❌ 文件檢索失敗：{e}")
+        return []
+
+async def recall_memories(user_message: str, conversation_id: str, ctx: RequestContext = None) -> str:
     """根據使用者輸入，從記憶資料庫中召回相關對話記憶"""
     try:
         # 使用語義搜尋獲取相關記憶
-        raw_memories = await search_relevant_memories(conversation_id, user_message, limit=3)
+        raw_memories = await search_relevant_memories(conversation_id, user_message, limit=3, ctx=ctx)
         
         if not raw_memories:
-            # Fallback to recent 5 memories if no semantic match
-            recent_result = supabase.table(MEMORIES_TABLE)\
-                .select("user_message, assistant_message")\
-                .eq("conversation_id", conversation_id)\
-                .eq("memory_type", "conversation")\
-                .order("created_at", desc=True)\
-                .limit(5)\
-                .execute()
-            if recent_result.data:
-                raw_memories = "\n".join([f"相關記憶: {m['user_message']} -> {m['assistant_message']}" for m in recent_result.data])
+            # Fallback to recent 5 memories if no semantic match（與對話歷史共用同一次查詢）
+            recent_rows = await fetch_recent_conversations(conversation_id, 5, ctx)
+            if recent_rows:
+                raw_memories = "\n".join([f"相關記憶: {m['user_message']} -> {m['assistant_message']}" for m in recent_rows])
         
-        if not raw_memories:
+        # 相關的文件段落（與記憶搜尋共用同一個查詢嵌入）
+        document_chunks = await recall_document_chunks(user_message, conversation_id, ctx)
+
+        if not raw_memories and not document_chunks:
             return ""
         
         # 格式化記憶為指定格式
-        memory_lines = raw_memories.split("\n")
+        memory_lines = (raw_memories or "").split("\n")
         formatted_memories = ["【喚醒記憶】"]
         for line in memory_lines:
             if line.startswith("相關記憶:"):
@@ -738,6 +1309,8 @@ async def recall_memories(user_message: str, conversation_id: str) -> str:
                     user_msg, assistant_msg = parts
                     formatted_memories.append(f"- 你曾對我說：「{user_msg}」")
                     formatted_memories.append(f"- 我當時回應你：「{assistant_msg}」")
+        for row in document_chunks:
+            formatted_memories.append(f"{DOCUMENT_CHUNK_PREFIX}{row['file_name']}》提到：「{row['chunk']}」")
         
         return "\n".join(formatted_memories) if len(formatted_memories) > 1 else ""
         
@@ -745,96 +1318,158 @@ async def recall_memories(user_message: str, conversation_id: str) -> str:
         print(f"❌ 記憶召回失敗：{e}")
         return ""
 
-async def summarize_memories(conversation_id: str) -> str:
-    """壓縮並摘要歷史記憶"""
+# 記憶摘要狀態：conversation_id -> {"summary", "watermark", "record_id", "stale"}
+# watermark 為已摘要的最後一筆對話的 created_at，儲存在摘要列的 created_at 欄位
+summary_cache = TTLCache(maxsize=SUMMARY_CACHE_SIZE)
+_summary_refreshing = {}  # conversation_id -> 背景更新中的 Task
+SUMMARY_TITLE = "記憶摘要"
+
+def mark_summary_stale(conversation_id: str):
+    """有新對話寫入時標記摘要需要更新"""
+    state = summary_cache.get(conversation_id)
+    if state is not None:
+        state["stale"] = True
+
+async def _load_summary_state(conversation_id: str) -> dict:
+    """從資料庫載入最新的摘要列（舊版可能有多筆，取最新一筆）"""
+    state = summary_cache.get(conversation_id)
+    if state is not None:
+        return state
+    result = await execute(supabase.table(MEMORIES_TABLE)\
+        .select("id, assistant_message, created_at")\
+        .eq("conversation_id", conversation_id)\
+        .eq("memory_type", "archived")\
+        .eq("user_message", SUMMARY_TITLE)\
+        .order("created_at", desc=True)\
+        .limit(1))
+    row = result.data[0] if result.data else None
+    state = {
+        "summary": row["assistant_message"] if row else "",
+        "watermark": row["created_at"] if row else None,
+        "record_id": row["id"] if row else None,
+        "stale": True  # 程序重啟後不知道之後是否有新對話
+    }
+    summary_cache.set(conversation_id, state)
+    return state
+
+async def refresh_summary(conversation_id: str):
+    """把 watermark 之後的新對話併入既有摘要，並前移 watermark"""
     try:
-        # 檢查歷史訊息數量
-        count_result = supabase.table(MEMORIES_TABLE)\
-            .select("id", count=True)\
-            .eq("conversation_id", conversation_id)\
-            .eq("memory_type", "conversation")\
-            .execute()
-        total_count = count_result.count
-        
-        if total_count <= 10:
-            return ""
-        
-        # 獲取最近 10 筆記憶
-        recent_result = supabase.table(MEMORIES_TABLE)\
-            .select("user_message, assistant_message")\
+        state = await _load_summary_state(conversation_id)
+        state["stale"] = False
+
+        query = supabase.table(MEMORIES_TABLE)\
+            .select("user_message, assistant_message, created_at")\
             .eq("conversation_id", conversation_id)\
-            .eq("memory_type", "conversation")\
-            .order("created_at", desc=True)\
-            .limit(10)\
-            .execute()
-        
-        if recent_result.data:
-            history_text = "\n".join([f"用戶: {m['user_message']}\n小宸光: {m['assistant_message']}" for m in recent_result.data])
-            
-            # 嘗試使用 GPT 生成摘要
-            try:
-                summary_response = client.chat.completions.create(
-                    model="gpt-4o-mini",
-                    messages=[
-                        {"role": "system", "content": "請將以下對話歷史壓縮成一段簡短的摘要："},
-                        {"role": "user", "content": history_text}
-                    ],
-                    max_tokens=100
-                ).choices[0].message.content
-                summary = summary_response
-            except Exception as e:
-                print(f"❌ GPT 摘要失敗：{e}")
-                summary = history_text  # Fallback to raw text
-            
-            # 儲存摘要
-            data = {
-                "conversation_id": conversation_id,
-                "user_message": "記憶摘要",
-                "assistant_message": summary,
-                "memory_type": "archived",
-                "platform": "telegram",
-                "document_content": summary,
-                "created_at": datetime.now().isoformat(),
-                "access_count": 0,
-                "importance_score": 0.5
-            }
-            supabase.table(MEMORIES_TABLE).insert(data).execute()
-            print(f"✅ 記憶摘要已儲存 - 用戶: {conversation_id[:8]}...")
-            return summary
-        
-        return ""
-        
+            .eq("memory_type", "conversation")
+        had_watermark = bool(state["watermark"])
+        if had_watermark:
+            # 由舊到新取 watermark 之後最早的一段，超過上限的較新對話留待下一次併入，不會被跳過
+            result = await execute(query.gt("created_at", state["watermark"]).order("created_at").limit(SUMMARY_FOLD_LIMIT))
+            new_rows = result.data or []
+        else:
+            # 第一次摘要以最近的對話為起點（長對話不必從最舊的對話開始逐段追上），之後從這裡往後併入
+            result = await execute(query.order("created_at", desc=True).limit(SUMMARY_FOLD_LIMIT))
+            new_rows = list(reversed(result.data or []))
+
+        # 還沒有摘要時，累積足夠的對話才開始摘要
+        if not new_rows or (not state["summary"] and len(new_rows) < SUMMARY_MIN_MESSAGES):
+            return
+
+        history_text = "\n".join([f"用戶: {m['user_message']}\n小宸光: {m['assistant_message']}" for m in new_rows])
+        if state["summary"]:
+            instruction = "以下是既有的對話摘要與之後的新對話，請把新對話併入，更新成一段簡短的摘要："
+            content = f"既有摘要：{state['summary']}\n\n新對話：\n{history_text}"
+        else:
+            instruction = "請將以下對話歷史壓縮成一段簡短的摘要："
+            content = history_text
+        summary = (await client.chat.completions.create(
+            model="gpt-4o-mini",
+            messages=[
+                {"role": "system", "content": instruction},
+                {"role": "user", "content": content}
+            ],
+            max_tokens=100
+        )).choices[0].message.content
+
+        # 同一個對話只保留一筆摘要列，原地更新
+        watermark = new_rows[-1]["created_at"]
+        data = {
+            "conversation_id": conversation_id,
+            "user_message": SUMMARY_TITLE,
+            "assistant_message": summary,
+            "memory_type": "archived",
+            "platform": "telegram",
+            "document_content": summary,
+            "created_at": watermark,
+            "access_count": 0,
+            "importance_score": 0.5
+        }
+        if state["record_id"]:
+            await execute(supabase.table(MEMORIES_TABLE).update(data).eq("id", state["record_id"]))
+        else:
+            inserted = await execute(supabase.table(MEMORIES_TABLE).insert(data))
+            if inserted.data:
+                state["record_id"] = inserted.data[0].get("id")
+        state["summary"] = summary
+        state["watermark"] = watermark
+        # 併入 watermark 之後的對話時取滿上限，表示之後可能還有未併入的對話
+        state["stale"] = had_watermark and len(new_rows) >= SUMMARY_FOLD_LIMIT
+        print(f"✅ 記憶摘要已更新 - 用戶: {conversation_id[:8]}..., 併入 {len(new_rows)} 筆新對話")
+
+    except Exception as e:
+        # watermark 不前移，下次再試
+        state = summary_cache.get(conversation_id)
+        if state is not None:
+            state["stale"] = True
+        print(f"❌ 記憶壓縮失敗：{e}")
+
+def schedule_summary_refresh(conversation_id: str):
+    """在背景更新摘要（同一對話同時只有一個更新在執行）"""
+    if conversation_id not in _summary_refreshing:
+        task = asyncio.ensure_future(refresh_summary(conversation_id))
+        _summary_refreshing[conversation_id] = task
+        task.add_done_callback(lambda _: _summary_refreshing.pop(conversation_id, None))
+
+async def summarize_memories(conversation_id: str) -> str:
+    """取得記憶摘要：直接回傳目前的滾動摘要，有新對話時在背景增量更新"""
+    try:
+        state = await _load_summary_state(conversation_id)
+        if state["stale"]:
+            schedule_summary_refresh(conversation_id)
+        return state["summary"]
     except Exception as e:
         print(f"❌ 記憶壓縮失敗：{e}")
         return ""
 
-def get_latest_trait(conversation_id: str) -> str:
+DEFAULT_TRAITS = "溫柔體貼, 活潑開朗, 細心耐心"
+DEFAULT_ADJUSTMENT = {"temperature": 0.8, "tone": "balanced_friendly", "suggested_emojis": ["😊", "✨"]}
+
+async def get_latest_trait(conversation_id: str) -> str:
     """從 xiaochenguang_personality 獲取最新個性描述"""
     try:
-        result = supabase.table("xiaochenguang_personality")\
+        result = await execute(supabase.table("xiaochenguang_personality")\
             .select("trait")\
             .eq("conversation_id", conversation_id)\
             .order("created_at", desc=True)\
-            .limit(1)\
-            .execute()
+            .limit(1))
         
         if result.data:
             return result.data[0]["trait"]
-        return "溫柔體貼, 活潑開朗, 細心耐心"  # 預設值
+        return DEFAULT_TRAITS  # 預設值
     except Exception as e:
         print(f"❌ 獲取個性特徵失敗：{e}")
-        return "溫柔體貼, 活潑開朗, 細心耐心"
+        return DEFAULT_TRAITS
 
 async def adapt_personality(emotion_analysis: dict) -> dict:
     """根據情緒歷史調整個性與回應風格"""
     try:
         # 查詢最近 5 筆 emotional_states
-        result = supabase.table("emotional_states")\
+        result = await execute(supabase.table("emotional_states")\
             .select("emotion_type", "intensity")\
             .eq("conversation_id", emotion_analysis.get("conversation_id", ""))\
             .order("timestamp", desc=True)\
-            .limit(5)\
-            .execute()
+            .limit(5))
         
         emotions = result.data if result.data else []
         avg_intensity = sum(float(e["intensity"]) for e in emotions) / len(emotions) if emotions else emotion_analysis["intensity"]
@@ -859,47 +1494,161 @@ async def adapt_personality(emotion_analysis: dict) -> dict:
         }
     except Exception as e:
         print(f"❌ 個性調適失敗：{e}")
-        return {"temperature": 0.8, "tone": "balanced_friendly", "suggested_emojis": ["😊", "✨"]}
+        return dict(DEFAULT_ADJUSTMENT)
 
-async def generate_response(message: str, conversation_id: str, combined_personality: str, context_prompt: str, emotion_analysis: dict) -> str:
-    """生成 GPT 回應，整合記憶召回與個性"""
-    try:
-        # 召回記憶
-        memory = await recall_memories(message, conversation_id)
-        if not memory:
-            memory = await summarize_memories(conversation_id)
-        
-        # 獲取最新個性描述
-        traits = get_latest_trait(conversation_id)
-        
-        # 調整個性
-        personality_adjustment = await adapt_personality(emotion_analysis)
-        adjusted_temperature = personality_adjustment["temperature"]
-        suggested_emojis = personality_adjustment["suggested_emojis"]
-        
-        # 構建提示，整合記憶與個性
-        prompt = f"""
-你是小宸光，一個具有記憶與獨特個性的 AI。
+async def gather_context(ctx: RequestContext, conversation_id: str, user_input: str, emotion_analysis: dict) -> dict:
+    """並行收集生成回應所需的所有上下文
+
+    互不相依的查詢同時進行，只有「摘要」需要等「記憶召回」結果為空時才執行；
+    每個階段各自逾時，逾時則以預設值代替。
+    """
+    async def summary_stage(recalled):
+        return "" if recalled else await summarize_memories(conversation_id)
+
+    graph = StageGraph("上下文收集")
+    # 失敗或逾時時使用預設狀態的個性引擎（基本人設；loaded 為 False，不會寫回資料庫）
+    graph.add("personality", lambda: get_personality_engine(conversation_id),
+              timeout=CONTEXT_STAGE_TIMEOUT, default=PersonalityEngine(conversation_id))
+    graph.add("history", lambda: fetch_recent_conversations(conversation_id, 5, ctx),
+              timeout=CONTEXT_STAGE_TIMEOUT, default=[])
+    graph.add("relevant_memories", lambda: search_relevant_memories(conversation_id, user_input, limit=3, ctx=ctx),
+              timeout=CONTEXT_STAGE_TIMEOUT, default="")
+    graph.add("recalled", lambda: recall_memories(user_input, conversation_id, ctx),
+              timeout=CONTEXT_STAGE_TIMEOUT, default="")
+    graph.add("summary", summary_stage, deps=["recalled"], timeout=SUMMARY_STAGE_TIMEOUT, default="")
+    graph.add("traits", lambda: get_latest_trait(conversation_id), timeout=CONTEXT_STAGE_TIMEOUT, default=DEFAULT_TRAITS)
+    graph.add("adjustment", lambda: adapt_personality(emotion_analysis),
+              timeout=CONTEXT_STAGE_TIMEOUT, default=dict(DEFAULT_ADJUSTMENT))
+
+    gathered = await graph.run()
+    print(f"⏱️ 上下文收集完成: {graph.format_timings()}")
+    return gathered
+
+def _memory_units(text: str) -> list:
+    """把「相關記憶: 使用者 -> 回應」格式拆成 (去重鍵, 文字) 單位（跨行內容併入上一筆）"""
+    units = []
+    for line in text.split("\n"):
+        if line.startswith("相關記憶:"):
+            user_msg = line.replace("相關記憶: ", "").split(" -> ")[0]
+            units.append((dedupe_key(user_msg), line))
+        elif units:
+            units[-1] = (units[-1][0], f"{units[-1][1]}\n{line}")
+    return units
+
+def _recalled_units(text: str) -> list:
+    """把【喚醒記憶】區塊拆成每組「你曾對我說／我當時回應你」、每個文件段落各一個單位"""
+    units = []
+    prefix = "- 你曾對我說：「"
+    for line in text.split("\n"):
+        if line.startswith(prefix):
+            units.append((dedupe_key(line[len(prefix):].rstrip("」")), line))
+        elif line.startswith(DOCUMENT_CHUNK_PREFIX):
+            units.append((dedupe_key(line), line))
+        elif units:
+            units[-1] = (units[-1][0], f"{units[-1][1]}\n{line}")
+    return units
+
+def assemble_system_prompt(message: str, persona_suffix: str, gathered: dict) -> str:
+    """在 token 預算內組合 system prompt
+
+    逐字不變的人設前綴（含回應指導與情感語調對照）放在最前面，讓 prompt 快取可以命中；
+    其後依序是對話歷史、記憶與本次問題，每次隨機或依情感變動的個性段落放在最後面。
+    人設、本次個性段落與回應指示一定保留；其餘依「最近對話 → 相關記憶 → 召回記憶 → 記憶摘要」的順序填入預算，
+    後面段落中與前面重複的對話會被略過。
+    """
+    traits = gathered["traits"]
+    # 回應指示（記憶欄位之外的部分；固定的身份說明已在人設前綴中）
+    instructions = f"個性描述：{traits}\n使用者說：「{message}」\n你會如何回應？"
+    history_units = [
+        (dedupe_key(row["user_message"]), f"用戶: {row['user_message']}\n小宸光: {row['assistant_message']}")
+        for row in reversed(gathered["history"] or [])
+    ]
+
+    assembler = ContextAssembler()
+    persona_prefix = xiaochenguang_soul.persona_prefix()
+    assembler.add("persona_prefix", [persona_prefix], required=True)
+    assembler.add("persona", [persona_suffix], required=True)
+    assembler.add("history", history_units, priority=1, header="\n### 最近對話\n", keep_newest=True)
+    assembler.add("memories", _memory_units(gathered["relevant_memories"] or ""), priority=2, header="\n### 相關記憶\n")
+    assembler.add("recalled", _recalled_units(gathered["recalled"] or ""), priority=3, header="【喚醒記憶】\n")
+    # 原本只在沒有召回記憶時才使用摘要
+    if not gathered["recalled"]:
+        assembler.add("summary", [gathered["summary"] or ""], priority=4)
+    assembler.add("instructions", [instructions], required=True)
+    sections = assembler.build()
+    print(f"🧮 提示詞 token 估算: {assembler.format_report()}")
+
+    # 召回記憶（沒有時使用記憶摘要）
+    memory = sections["recalled"] or sections.get("summary", "")
+    context_prompt = "".join(f"{section}\n" for section in (sections["history"], sections["memories"]) if section)
+
+    # 構建提示，整合記憶與個性
+    prompt = f"""
 個性描述：{traits}
 最近記憶：{memory if memory else "無最近記憶"}
 
 使用者說：「{message}」
 你會如何回應？
 """
+    return f"{persona_prefix}\n{context_prompt}\n{prompt}\n{persona_suffix}"
+
+# 回應的 prompt token 與快取命中統計
+prompt_cache_stats = PromptCacheStats()
+
+def record_usage(usage):
+    usage_info = prompt_cache_stats.record(usage)
+    if usage_info:
+        print(f"🧾 prompt tokens: {usage_info['prompt_tokens']}，快取命中 {usage_info['cached_tokens']} ({usage_info['cached_ratio']:.0%})")
+
+async def generate_response(message: str, conversation_id: str, persona_suffix: str, emotion_analysis: dict, ctx: RequestContext = None, gathered: dict = None, stream_to: StreamingReply = None) -> str:
+    """生成 GPT 回應，整合記憶召回與個性（提供 stream_to 時以串流方式逐步送出）"""
+    try:
+        if gathered is None:
+            gathered = await gather_context(ctx, conversation_id, message, emotion_analysis)
         
-        # 將記憶與個性提示追加到現有 system prompt
-        full_prompt = f"{combined_personality}\n{context_prompt}\n{prompt}"
+        # 調整個性
+        personality_adjustment = gathered["adjustment"]
+        adjusted_temperature = personality_adjustment["temperature"]
+        suggested_emojis = personality_adjustment["suggested_emojis"]
+        
+        # 在 token 預算內整合個性、對話歷史、記憶與摘要
+        full_prompt = assemble_system_prompt(message, persona_suffix, gathered)
         
         # 調用 GPT
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": full_prompt},
-                {"role": "user", "content": message}
-            ],
-            temperature=adjusted_temperature,
-            max_tokens=1000
-        ).choices[0].message.content
+        messages = [
+            {"role": "system", "content": full_prompt},
+            {"role": "user", "content": message}
+        ]
+        if stream_to is None:
+            completion = await client.chat.completions.create(
+                model="gpt-4o-mini",
+                messages=messages,
+                temperature=adjusted_temperature,
+                max_tokens=1000
+            )
+            record_usage(completion.usage)
+            response = completion.choices[0].message.content
+        else:
+            stream = await client.chat.completions.create(
+                model="gpt-4o-mini",
+                messages=messages,
+                temperature=adjusted_temperature,
+                max_tokens=1000,
+                stream=True,
+                stream_options={"include_usage": True}
+            )
+            parts = []
+            async for chunk in stream:
+                # 最後一個 chunk 只帶 usage
+                if getattr(chunk, "usage", None) is not None:
+                    record_usage(chunk.usage)
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    parts.append(delta)
+                    await stream_to.feed(delta)
+            response = "".join(parts)
         
         # 根據語氣調整回應
         if random.random() < 0.5 and suggested_emojis:
@@ -911,62 +1660,101 @@ async def generate_response(message: str, conversation_id: str, combined_persona
         print(f"❌ 生成回應失敗：{e}")
         return "哈尼，我現在有點累了，稍微休息一下再陪你聊天好嗎？💛"
 
+# 回覆後的背景工作佇列：處理器送出回覆後立即返回
+post_reply_queue = JobQueue("post_reply")
+
+_learning_locks = weakref.WeakValueDictionary()  # conversation_id -> asyncio.Lock
+
+async def learn_and_refresh(conversation_id: str, user_input: str, response: str, emotion_analysis: dict):
+    """學習成長（包含情感分析），並定期從資料庫重新載入個性
+
+    背景佇列有多個工作者，同一對話的學習以鎖依序執行，重新載入不會蓋掉另一次學習的結果。
+    引擎在執行時才從快取取得：排隊期間原本的引擎可能已被淘汰、由新載入的引擎取代，
+    若沿用舊物件，標記寫回時會以舊狀態覆蓋較新的個性。
+    """
+    lock = _learning_locks.get(conversation_id)
+    if lock is None:
+        lock = asyncio.Lock()
+        _learning_locks[conversation_id] = lock
+    async with lock:
+        personality_engine = await get_personality_engine(conversation_id)
+        await _learn_and_refresh(personality_engine, user_input, response, emotion_analysis)
+
+async def _learn_and_refresh(personality_engine: PersonalityEngine, user_input: str, response: str, emotion_analysis: dict):
+    await personality_engine.learn_from_interaction(user_input, response, emotion_analysis)
+
+    # 定期更新個性特徵（1%機率）
+    if random.random() < 0.01:
+        if personality_writer.is_dirty(personality_engine.conversation_id):
+            await personality_writer.flush()
+        await personality_engine.load_personality()
+        print(f"🔄 個性特徵已更新 - 快取統計: {personality_cache.stats()}")
+        print(f"📊 背景工作佇列: {post_reply_queue.stats()}")
+
 async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # 這裡是處理照片的原有邏輯
     pass  # 如果你有舊的 handle_photo 程式碼，替換掉這行
 
 async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """文件與文字訊息經過同一個對話分派器，同一對話的 update 依收到的順序處理"""
+    await message_dispatcher.submit(str(update.effective_user.id), ("document", update, context))
+
+async def process_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
     conversation_id = str(update.effective_user.id)
-    result_msg = await handle_file(update, context, conversation_id)
+    result_msg = await handle_file(update, context, conversation_id, ingest=ingest_document)
     await update.message.reply_text(result_msg)
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """處理訊息（強化情感識別版）"""
+    """處理訊息：交給對話分派器（同一對話依序處理，連續送出的短訊息合併成一次回應）"""
+    conversation_id = str(update.message.from_user.id)
+    await message_dispatcher.submit(conversation_id, ("text", update, context))
+
+async def process_updates(conversation_id: str, items: list):
+    """依序處理同一對話的一批 update：相鄰的文字訊息合併處理，文件逐一處理"""
+    for kind, group in itertools.groupby(items, key=lambda item: item[0]):
+        group = list(group)
+        if kind == "text":
+            await process_messages(conversation_id, [update for _, update, _ in group])
+        else:
+            for _, update, context in group:
+                await process_document(update, context)
+
+async def process_messages(conversation_id: str, updates: list):
+    """處理同一對話的一批訊息（強化情感識別版）：合併成一次情感分析與一次 GPT 呼叫，回覆最後一則"""
+    update = updates[-1]
     try:
-        user_input = update.message.text
-        conversation_id = str(update.message.from_user.id)
-        
-        # 初始化系統組件
-        personality_engine = PersonalityEngine(conversation_id)
-        xiaochenguang_soul = XiaoChenGuangSoul()
-        emotion_detector = EnhancedEmotionDetector()
+        user_input = "\n".join(item.message.text for item in updates)
+        if len(updates) > 1:
+            print(f"🧺 合併 {len(updates)} 則連續訊息 - 用戶: {conversation_id[:8]}...")
+        ctx = RequestContext(conversation_id)
         
         # 🎭 進行情感分析
         emotion_analysis = emotion_detector.analyze_emotion(user_input)
         print(f"🎭 情感分析結果: {emotion_analysis['dominant_emotion']} (強度: {emotion_analysis['intensity']:.2f})")
         
-        # 獲取歷史對話
-        history = get_conversation_history(conversation_id, limit=5)
-
-        # 搜尋相關記憶
-        relevant_memories = await search_relevant_memories(conversation_id, user_input, limit=3)
+        # 並行收集個性、歷史對話、相關記憶、摘要與個性調整
+        gathered = await gather_context(ctx, conversation_id, user_input, emotion_analysis)
+        personality_engine = gathered["personality"]
         
         # 生成結合情感分析的動態提示
-        combined_personality = personality_engine.generate_combined_prompt(xiaochenguang_soul, emotion_analysis)
-        
-        # 構建完整的上下文
-        context_prompt = ""
-        if history:
-            context_prompt += f"\n### 最近對話\n{history}\n"
-        if relevant_memories:
-            context_prompt += f"\n### 相關記憶\n{relevant_memories}\n"
-
-        # 生成回應
-        response = await generate_response(user_input, conversation_id, combined_personality, context_prompt, emotion_analysis)
+        # （固定人設前綴在 assemble_system_prompt 中加入，這裡只產生每次變動的部分）
+        persona_suffix = personality_engine.generate_dynamic_prompt(xiaochenguang_soul, emotion_analysis)
+        
+        # 生成回應並回覆用戶（串流模式下第一句完成就先送出，之後節流編輯）
+        if STREAMING_REPLIES:
+            reply = StreamingReply(update.message)
+            response = await generate_response(user_input, conversation_id, persona_suffix, emotion_analysis, ctx, gathered, stream_to=reply)
+            await reply.finish(response)
+            print(f"💬 串流回覆: {reply.stats()}")
+        else:
+            response = await generate_response(user_input, conversation_id, persona_suffix, emotion_analysis, ctx, gathered)
+            await update.message.reply_text(response)
 
-        # 回覆用戶
-        await update.message.reply_text(response)
-
-        # 儲存記憶
-        await add_to_memory(conversation_id, user_input, response, emotion_analysis)
-        
-        # 學習成長（包含情感分析）
-        personality_engine.learn_from_interaction(user_input, response, emotion_analysis)
-        
-        # 定期更新個性特徵（1%機率）
-        if random.random() < 0.01:
-            personality_engine.load_personality()
-            print("🔄 個性特徵已更新")
+        # 儲存記憶與學習成長交給背景佇列（佇列已滿時在此等待，形成背壓）
+        remember_unsaved_turn(conversation_id, user_input, response)
+        await post_reply_queue.submit("add_to_memory", add_to_memory, conversation_id, user_input, response, emotion_analysis)
+        # 學習會直接修改個性狀態，重試會重複計數，因此不重試
+        await post_reply_queue.submit("learn_from_interaction", learn_and_refresh, conversation_id, user_input, response, emotion_analysis, retries=0)
 
     except APIError as e:
         # 根據用戶情感狀態調整錯誤回應
@@ -982,6 +1770,171 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(error_message)
         print(f"❌ 處理訊息時發生錯誤: {e}")
 
+# 對話分派器：同一對話一次只處理一批訊息，避免記憶寫入與個性狀態互相覆蓋
+# sequential 模式下一次只處理一個 update，等待期間不會有後續訊息進來合併，因此不等待
+message_dispatcher = ConversationDispatcher(
+    process_updates,
+    window=0.0 if UPDATE_PROCESSING == "sequential" else MESSAGE_DEBOUNCE_WINDOW,
+    name="messages"
+)
+
+async def on_startup(app):
+    """機器人啟動時測試 OpenAI 連接（非同步客戶端需在事件循環中使用）"""
+    try:
+        await client.chat.completions.create(
+            model="gpt-4o-mini",
+            messages=[{"role": "system", "content": "測試"}],
+            max_tokens=10
+        )
+        print("✅ OpenAI API 連接成功")
+    except Exception as e:
+        print(f"❌ OpenAI API 連接失敗: {e}")
+        print("請檢查 API Key 是否有效")
+        raise
+
+    if PERSONALITY_WRITE_BEHIND:
+        personality_writer.start()
+    post_reply_queue.start()
+
+async def on_shutdown(app):
+    """機器人關閉時釋放連線與執行緒池"""
+    # 先處理完已收到的訊息，再結束背景工作
+    await message_dispatcher.drain()
+    print(f"📊 訊息分派統計: {message_dispatcher.stats()}")
+    # 先處理完背景工作（學習會標記個性為待寫入），再寫回個性
+    await post_reply_queue.stop(timeout=JOB_QUEUE_DRAIN_TIMEOUT)
+    print(f"📊 背景工作佇列統計: {post_reply_queue.stats()}")
+    if _summary_refreshing:
+        await asyncio.gather(*list(_summary_refreshing.values()), return_exceptions=True)
+    await personality_writer.stop()
+    print(f"📊 個性快取統計: {personality_cache.stats()}")
+    print(f"📊 個性寫入統計: {personality_writer.stats()}")
+    print(f"📊 嵌入快取統計: {embedding_cache.stats()}")
+    print(f"📊 Prompt 快取統計: {prompt_cache_stats.stats()}")
+    print(f"📊 批次統計: 嵌入 {embedding_batcher.stats()}，記憶寫入 {memory_writer.stats()}")
+    print(f"📊 關鍵字索引統計: {lexical_index.stats()}")
+    print(f"📊 文件快取統計: {document_cache.stats()}")
+    embedding_cache.close()
+    document_cache.close()
+    await clients.close_clients()
+    shutdown_extraction_pool()
+    shutdown_executor()
+    print("👋 小宸光已安全關閉")
+
+def build_application(with_updater: bool = True):
+    """建立 Application 並註冊處理器（分片工作程序不需要 updater，update 由前端轉送）"""
+    builder = ApplicationBuilder()\
+        .token(BOT_TOKEN)\
+        .concurrent_updates(MAX_CONCURRENT_UPDATES if UPDATE_PROCESSING == "concurrent" else False)\
+        .post_init(on_startup)\
+        .post_shutdown(on_shutdown)
+    if not with_updater:
+        builder = builder.updater(None)
+    app = builder.build()
+    
+    # 添加消息處理器
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    app.add_handler(MessageHandler(filters.PHOTO, handle_photo))
+    app.add_handler(MessageHandler(filters.Document.ALL, handle_document))
+    app.add_handler(CallbackQueryHandler(download_full_file, pattern=r"^download_"))
+    return app
+
+async def _serve_shard(app, address, authkey: bytes):
+    async with app:
+        # 沒有使用 run_polling / run_webhook，啟動與關閉的掛勾要自己呼叫
+        await on_startup(app)
+        await app.start()
+
+        async def handle(data: dict):
+            await app.update_queue.put(Update.de_json(data, app.bot))
+
+        print(f"🧩 分片工作程序已啟動 - {address[0]}:{address[1]}（pid {os.getpid()}）")
+        try:
+            await serve_worker(address, authkey, handle)
+        finally:
+            # 已轉送進來的 update 先交給處理器，app.stop() 才會等待它們完成
+            while not app.update_queue.empty():
+                await asyncio.sleep(0.05)
+            await app.stop()
+            await on_shutdown(app)
+
+def run_shard_worker(address, authkey: bytes):
+    """分片工作程序：從前端的 IPC 連線接收 update，交給本程序的 Application 處理"""
+    asyncio.run(_serve_shard(build_application(with_updater=False), address, authkey))
+
+async def _set_webhook():
+    async with Bot(BOT_TOKEN) as telegram_bot:
+        await telegram_bot.set_webhook(
+            url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET_TOKEN,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            drop_pending_updates=True
+        )
+
+def run_sharded_front():
+    """分片前端：接收 Telegram webhook，依 conversation_id 雜湊轉送到各工作程序
+
+    未設定 SHARD_WORKER_ADDRESSES 時在本機啟動 SHARD_WORKERS 個工作程序；
+    設定時轉送到其他節點上以 shard-worker 模式執行的工作程序。
+    """
+    if not WEBHOOK_URL:
+        print("❌ 分片模式需要設定 WEBHOOK_URL")
+        return
+    addresses = configured_addresses()
+    if addresses and not SHARD_AUTHKEY:
+        print("❌ 轉送到其他節點時需要設定 SHARD_AUTHKEY")
+        return
+    authkey = resolve_authkey()
+    processes = []
+    if not addresses:
+        addresses = local_addresses(SHARD_WORKERS)
+        processes = spawn_workers(run_shard_worker, addresses, authkey)
+
+    # SIGTERM（例如平台重新部署）與 Ctrl+C 一樣走正常的關閉流程
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    router = ShardRouter(addresses, authkey)
+    server = None
+    try:
+        router.connect_all()
+        server = start_front_server(router, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_SECRET_TOKEN)
+        asyncio.run(_set_webhook())
+        print(f"🌐 分片前端：監聽 {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{WEBHOOK_PATH}，{len(addresses)} 個工作程序")
+        while not processes or all(process.is_alive() for process in processes):
+            time.sleep(1)
+        print("❌ 有工作程序異常結束，關閉分片前端")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if server is not None:
+            server.shutdown()
+        router.close(shutdown_workers=bool(processes))
+        stop_workers(processes, timeout=JOB_QUEUE_DRAIN_TIMEOUT + 10)
+        print(f"📊 分片轉送統計: {router.stats()}")
+
+def webhook_available() -> bool:
+    return importlib.util.find_spec("tornado") is not None
+
+def run_application(app):
+    """以長輪詢或 webhook 啟動機器人"""
+    if BOT_RUN_MODE == "webhook":
+        if not WEBHOOK_URL:
+            print("⚠️ 未設定 WEBHOOK_URL，改用長輪詢")
+        elif not webhook_available():
+            print("⚠️ 未安裝 python-telegram-bot[webhooks]，改用長輪詢")
+        else:
+            print(f"🌐 Webhook 模式：監聽 {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{WEBHOOK_PATH}")
+            app.run_webhook(
+                listen=WEBHOOK_LISTEN,
+                port=WEBHOOK_PORT,
+                url_path=WEBHOOK_PATH,
+                webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+                secret_token=WEBHOOK_SECRET_TOKEN,
+                max_connections=WEBHOOK_MAX_CONNECTIONS,
+                drop_pending_updates=True
+            )
+            return
+    app.run_polling(drop_pending_updates=True)
+
 def main():
     """主程式入口"""
     print("🌟 小宸光智能系統 v5.0 情感識別強化版 啟動中...")
@@ -1000,14 +1953,10 @@ def main():
     print("  ✅ 🎭 個性融合回應")
     print("  ✅ 🌱 個性學習與調節")
     
-    # 初始化小宸光的靈魂
-    global xiaochenguang_soul
-    xiaochenguang_soul = XiaoChenGuangSoul()
+    # 小宸光的靈魂為共用實例（人設前綴在第一次使用時產生並保留）
     print("✨ 小宸光的靈魂已注入")
     
-    # 初始化情感檢測器
-    global emotion_detector
-    emotion_detector = EnhancedEmotionDetector()
+    # 情感檢測器為共用實例（詞典已在載入時編譯）
     print("🎭 情感識別系統已就緒")
     
     # 檢查必要的環境變數
@@ -1041,29 +1990,20 @@ def main():
         print("請檢查 Supabase 配置是否正確")
         return
     
-    # 測試OpenAI連接
-    try:
-        test_completion = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[{"role": "system", "content": "測試"}],
-            max_tokens=10
-        )
-        print("✅ OpenAI API 連接成功")
-        
-    except Exception as e:
-        print(f"❌ OpenAI API 連接失敗: {e}")
-        print("請檢查 API Key 是否有效")
+    # 分片模式：前端只負責接收 webhook 並依用戶轉送，工作程序各自執行完整的機器人
+    if BOT_RUN_MODE == "sharded":
+        run_sharded_front()
+        return
+    if BOT_RUN_MODE == "shard-worker":
+        if not SHARD_AUTHKEY:
+            print("❌ shard-worker 模式需要設定 SHARD_AUTHKEY（與前端相同）")
+            return
+        run_shard_worker((SHARD_LISTEN, SHARD_BASE_PORT), SHARD_AUTHKEY.encode("utf-8"))
         return
     
     # 建立並啟動機器人
     try:
-        app = ApplicationBuilder().token(BOT_TOKEN).build()
-        
-        # 添加消息處理器
-        app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
-        app.add_handler(MessageHandler(filters.PHOTO, handle_photo))
-        app.add_handler(MessageHandler(filters.Document.ALL, handle_document))
-        app.add_handler(CallbackQueryHandler(download_full_file, pattern=r"^download_"))
+        app = build_application()
         
         print("🎉 小宸光已經準備好了！")
         print("💛 正在等待來自哈尼的訊息...")
@@ -1072,7 +2012,8 @@ def main():
         print("-" * 50)
         
         # 啟動機器人
-        app.run_polling(drop_pending_updates=True)
+        print(f"⚙️ update 處理模式: {UPDATE_PROCESSING}（上限 {MAX_CONCURRENT_UPDATES}）")
+        run_application(app)
         
     except Exception as e:
         print(f"❌ 機器人啟動失敗: {e}")
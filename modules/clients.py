@@ -0,0 +1,118 @@
+import os
+import threading
+import importlib.util
+import httpx
+from dotenv import load_dotenv
+from openai import AsyncOpenAI
+from postgrest.utils import SyncClient
+from supabase import create_client, Client
+from supabase.lib.client_options import ClientOptions
+from modules.executor import IO_MAX_WORKERS
+
+load_dotenv()
+
+SUPABASE_URL = os.getenv("SUPABASE_URL")
+SUPABASE_KEY = os.getenv("SUPABASE_KEY")
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+
+# 連線池設定：所有模組共用同一組 keep-alive 連線
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", str(max(64, IO_MAX_WORKERS))))
+HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", "32"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "60"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+OPENAI_READ_TIMEOUT = float(os.getenv("OPENAI_READ_TIMEOUT", "60"))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "2"))
+SUPABASE_READ_TIMEOUT = float(os.getenv("SUPABASE_READ_TIMEOUT", "30"))
+STORAGE_READ_TIMEOUT = float(os.getenv("STORAGE_READ_TIMEOUT", "120"))
+# HTTP/2 需要安裝 h2（pip install "httpx[http2]"），沒有安裝時自動使用 HTTP/1.1
+HTTP2_ENABLED = os.getenv("HTTP2_ENABLED", "true").lower() in ("1", "true", "yes") \
+    and importlib.util.find_spec("h2") is not None
+
+
+def _limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY
+    )
+
+
+def _timeout(read: float) -> httpx.Timeout:
+    return httpx.Timeout(read, connect=HTTP_CONNECT_TIMEOUT)
+
+
+def _pooled_session(session, read_timeout: float) -> SyncClient:
+    """以共用的連線池設定重建 supabase 子客戶端的 httpx session（保留原本的 base_url 與標頭）"""
+    pooled = SyncClient(
+        base_url=session.base_url,
+        headers=session.headers,
+        timeout=_timeout(read_timeout),
+        limits=_limits(),
+        http2=HTTP2_ENABLED
+    )
+    session.close()
+    return pooled
+
+
+def build_openai() -> AsyncOpenAI:
+    return AsyncOpenAI(
+        api_key=OPENAI_API_KEY,
+        max_retries=OPENAI_MAX_RETRIES,
+        timeout=_timeout(OPENAI_READ_TIMEOUT),
+        http_client=httpx.AsyncClient(
+            timeout=_timeout(OPENAI_READ_TIMEOUT),
+            limits=_limits(),
+            http2=HTTP2_ENABLED
+        )
+    )
+
+
+def build_supabase() -> Client:
+    supabase_client = create_client(SUPABASE_URL, SUPABASE_KEY, options=ClientOptions(
+        postgrest_client_timeout=SUPABASE_READ_TIMEOUT,
+        storage_client_timeout=STORAGE_READ_TIMEOUT
+    ))
+    # supabase 1.x 的 postgrest / storage 各自建立預設 httpx.Client，換成可調整連線池的版本
+    supabase_client.postgrest.session = _pooled_session(supabase_client.postgrest.session, SUPABASE_READ_TIMEOUT)
+    storage = supabase_client.storage
+    storage.session = _pooled_session(storage.session, STORAGE_READ_TIMEOUT)
+    storage._client = storage.session
+    return supabase_client
+
+
+class LazyClient:
+    """第一次使用時才建立的共用客戶端（屬性存取轉交給實際的客戶端）"""
+
+    def __init__(self, factory, name: str):
+        self._factory = factory
+        self._name = name
+        self._instance = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        if self._instance is None:
+            with self._lock:
+                if self._instance is None:
+                    self._instance = self._factory()
+                    print(f"🔌 已建立共用 {self._name} 客戶端（HTTP/2: {'開啟' if HTTP2_ENABLED else '關閉'}）")
+        return self._instance
+
+    @property
+    def created(self) -> bool:
+        return self._instance is not None
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+
+openai_client = LazyClient(build_openai, "OpenAI")
+supabase = LazyClient(build_supabase, "Supabase")
+
+
+async def close_clients():
+    """關閉共用客戶端的連線池（只關閉已建立的）"""
+    if openai_client.created:
+        await openai_client.close()
+    if supabase.created:
+        supabase.postgrest.session.close()
+        supabase.storage.session.close()
@@ -0,0 +1,105 @@
+import os
+import re
+
+# system prompt 的 token 預算（本機估算）
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "3000"))
+
+_CJK_CHARS = re.compile(r"[\u3000-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]")
+_DEDUPE_STRIP = re.compile(r"[\s\W_]+")
+
+
+def estimate_tokens(text: str) -> int:
+    """本機估算 token 數：中日韓字元約一字一 token，其餘約四個字元一 token"""
+    if not text:
+        return 0
+    cjk = len(_CJK_CHARS.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def dedupe_key(text: str) -> str:
+    """比對重複內容用的鍵（忽略空白與標點、不分大小寫）"""
+    return _DEDUPE_STRIP.sub("", text).lower()
+
+
+class ContextAssembler:
+    """在 token 預算內依優先順序組合提示的各個段落
+
+    每個段落由多個單位（一句、一組對話）組成；必要段落一定保留，其餘依 priority
+    由小到大填入預算，填不下的單位捨棄。單位可帶去重鍵，較高優先的段落已出現的內容
+    不會在後面的段落重複出現。
+    """
+
+    def __init__(self, budget: int = CONTEXT_TOKEN_BUDGET):
+        self.budget = budget
+        self._sections = {}
+        self.report = {}
+
+    def add(self, name: str, units, priority: int = 0, header: str = "", required: bool = False,
+            keep_newest: bool = False, separator: str = "\n"):
+        """註冊段落；units 為字串或 (去重鍵, 字串) 的列表。keep_newest 時預算不足優先保留最後面的單位"""
+        normalized = []
+        for unit in units:
+            key, text = unit if isinstance(unit, tuple) else (dedupe_key(unit), unit)
+            if text:
+                normalized.append((key, text))
+        self._sections[name] = {
+            "units": normalized,
+            "priority": -1 if required else priority,
+            "header": header,
+            "required": required,
+            "keep_newest": keep_newest,
+            "separator": separator
+        }
+        return self
+
+    def build(self) -> dict:
+        """回傳 {段落名稱: 組合後文字}（依註冊順序），並在 report 記錄每段的 token 數與捨棄數"""
+        remaining = self.budget
+        seen = set()
+        kept = {}
+        self.report = {}
+
+        for name, section in sorted(self._sections.items(), key=lambda item: item[1]["priority"]):
+            units = section["units"][::-1] if section["keep_newest"] else section["units"]
+            header_tokens = estimate_tokens(section["header"])
+            chosen = []
+            tokens = 0
+            dropped = 0
+            for i, (key, text) in enumerate(units):
+                if key and key in seen:
+                    dropped += 1
+                    continue
+                cost = estimate_tokens(text) + (header_tokens if not chosen else 0)
+                if not section["required"] and cost > remaining:
+                    if section["keep_newest"]:
+                        # 依時間排列的段落保持連續，不跳過較新的內容去放較舊的
+                        dropped += len(units) - i
+                        break
+                    dropped += 1
+                    continue
+                chosen.append(text)
+                if key:
+                    seen.add(key)
+                tokens += cost
+                remaining -= cost
+            if section["keep_newest"]:
+                chosen.reverse()
+            kept[name] = chosen
+            self.report[name] = {"tokens": tokens, "kept": len(chosen), "dropped": dropped}
+
+        result = {}
+        for name, section in self._sections.items():
+            if kept[name]:
+                body = section["separator"].join(kept[name])
+                result[name] = f"{section['header']}{body}" if section["header"] else body
+            else:
+                result[name] = ""
+        return result
+
+    def total_tokens(self) -> int:
+        return sum(item["tokens"] for item in self.report.values())
+
+    def format_report(self) -> str:
+        parts = [f"{name}={item['tokens']}" + (f"(-{item['dropped']})" if item["dropped"] else "")
+                 for name, item in self.report.items()]
+        return f"{', '.join(parts)}，合計 {self.total_tokens()}/{self.budget}"
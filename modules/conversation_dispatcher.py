@@ -0,0 +1,104 @@
+import os
+import time
+import asyncio
+
+# 連續訊息合併：最後一則訊息後等待的秒數、從第一則起最多等待的秒數、一次最多合併的則數
+MESSAGE_DEBOUNCE_WINDOW = float(os.getenv("MESSAGE_DEBOUNCE_WINDOW", "1.0"))
+MESSAGE_DEBOUNCE_MAX_WAIT = float(os.getenv("MESSAGE_DEBOUNCE_MAX_WAIT", "3.0"))
+MESSAGE_MERGE_MAX = int(os.getenv("MESSAGE_MERGE_MAX", "8"))
+
+
+class ConversationDispatcher:
+    """以對話為單位排隊處理訊息：同一對話一次只處理一批，連續送出的訊息合併成一批
+
+    每個對話有一個工作 task：收到訊息後等待 window 秒沒有新訊息（但從第一則起最多 max_wait 秒），
+    再以 process(key, items) 一次處理累積的訊息；處理期間新到的訊息留待下一批。
+    不同對話之間互不影響、可並行。submit() 在該則訊息所屬的批次處理完成後返回。
+    """
+
+    def __init__(self, process, window: float = MESSAGE_DEBOUNCE_WINDOW, max_wait: float = MESSAGE_DEBOUNCE_MAX_WAIT,
+                 max_batch: int = MESSAGE_MERGE_MAX, name: str = "dispatcher"):
+        self.process = process
+        self.window = window
+        self.max_wait = max_wait
+        self.max_batch = max_batch
+        self.name = name
+        self.batches = 0
+        self.items = 0
+        self._pending = {}  # key -> [(item, future)]
+        self._arrived = {}  # key -> asyncio.Event（有新訊息時設定，用於重新計時）
+        self._workers = {}  # key -> Task
+
+    async def submit(self, key, item):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.setdefault(key, []).append((item, future))
+        event = self._arrived.setdefault(key, asyncio.Event())
+        event.set()
+        if key not in self._workers:
+            task = asyncio.ensure_future(self._worker(key))
+            self._workers[key] = task
+        return await future
+
+    async def _collect(self, key) -> list:
+        """等待這一波訊息告一段落，取出最多 max_batch 則"""
+        event = self._arrived[key]
+        deadline = time.monotonic() + self.max_wait
+        while len(self._pending.get(key, ())) < self.max_batch:
+            event.clear()
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                await asyncio.wait_for(event.wait(), min(self.window, remaining))
+            except asyncio.TimeoutError:
+                break
+        pending = self._pending.get(key, [])
+        batch, self._pending[key] = pending[:self.max_batch], pending[self.max_batch:]
+        return batch
+
+    async def _worker(self, key):
+        try:
+            while self._pending.get(key):
+                batch = await self._collect(key)
+                if not batch:
+                    break
+                self.batches += 1
+                self.items += len(batch)
+                try:
+                    await self.process(key, [item for item, _ in batch])
+                    error = None
+                except Exception as e:
+                    error = e
+                except BaseException:
+                    # 被取消：這一批的呼叫者也一併取消
+                    for _, future in batch:
+                        future.cancel()
+                    raise
+                for _, future in batch:
+                    if future.done():
+                        continue
+                    if error is None:
+                        future.set_result(None)
+                    else:
+                        future.set_exception(error)
+        finally:
+            # 正常結束時佇列必定是空的；被取消時通知仍在等待的呼叫者
+            self._workers.pop(key, None)
+            self._arrived.pop(key, None)
+            for _, future in self._pending.pop(key, []):
+                if not future.done():
+                    future.cancel()
+
+    async def drain(self):
+        """等待所有對話目前排隊中的訊息處理完成"""
+        while self._workers:
+            await asyncio.gather(*list(self._workers.values()), return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "avg_batch": round(self.items / self.batches, 2) if self.batches else 0.0,
+            "active": len(self._workers)
+        }
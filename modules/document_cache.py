@@ -0,0 +1,191 @@
+import os
+import time
+import json
+import asyncio
+import sqlite3
+import threading
+import weakref
+from modules.executor import run_blocking
+
+# 文件處理結果快取：以內容雜湊為鍵，Telegram 的 file_unique_id 對應到內容雜湊
+DOCUMENT_CACHE_PATH = os.getenv("DOCUMENT_CACHE_PATH", os.path.join("data", "document_cache.sqlite3"))
+DOCUMENT_CACHE_MAX_ROWS = int(os.getenv("DOCUMENT_CACHE_MAX_ROWS", "5000"))
+
+
+class DocumentCache:
+    """文件處理結果的本機 SQLite 快取
+
+    同一份內容（不論哪位使用者、檔名為何）只擷取、上傳、摘要一次；
+    再次收到時以 file_unique_id 或內容雜湊查一次表即可取得先前的結果。
+    """
+
+    def __init__(self, path: str = DOCUMENT_CACHE_PATH, max_rows: int = DOCUMENT_CACHE_MAX_ROWS):
+        self.path = path
+        self.max_rows = max_rows
+        self.hits = 0
+        self.misses = 0
+        self._conn = None
+        self._lock = threading.Lock()
+        # 同一份內容同時被處理時，只讓第一個請求真正執行
+        self._key_locks = weakref.WeakValueDictionary()
+
+    def _connect(self):
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS documents ("
+                "content_hash TEXT PRIMARY KEY, object_name TEXT, uploaded INTEGER DEFAULT 0, "
+                "extraction TEXT, summary TEXT, last_used REAL)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS file_aliases (file_unique_id TEXT PRIMARY KEY, content_hash TEXT)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS document_links ("
+                "content_hash TEXT, conversation_id TEXT, PRIMARY KEY (content_hash, conversation_id))"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_documents_last_used ON documents(last_used)")
+        return self._conn
+
+    def _lookup(self, content_hash: str = None, file_unique_id: str = None):
+        with self._lock:
+            conn = self._connect()
+            if content_hash is None:
+                row = conn.execute(
+                    "SELECT content_hash FROM file_aliases WHERE file_unique_id = ?", (file_unique_id,)
+                ).fetchone()
+                if row is None:
+                    return None
+                content_hash = row[0]
+            row = conn.execute(
+                "SELECT content_hash, object_name, uploaded, extraction, summary FROM documents WHERE content_hash = ?",
+                (content_hash,)
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE documents SET last_used = ? WHERE content_hash = ?", (time.time(), content_hash))
+            conn.commit()
+        return {
+            "content_hash": row[0],
+            "object_name": row[1],
+            "uploaded": bool(row[2]),
+            "extraction": json.loads(row[3]) if row[3] else None,
+            "summary": row[4]
+        }
+
+    def _store(self, content_hash: str, fields: dict, file_unique_id: str = None):
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "INSERT OR IGNORE INTO documents (content_hash, last_used) VALUES (?, ?)",
+                (content_hash, time.time())
+            )
+            for column, value in fields.items():
+                if column == "extraction":
+                    value = json.dumps(value, ensure_ascii=False)
+                elif column == "uploaded":
+                    value = int(bool(value))
+                conn.execute(f"UPDATE documents SET {column} = ? WHERE content_hash = ?", (value, content_hash))
+            if file_unique_id:
+                conn.execute(
+                    "INSERT OR REPLACE INTO file_aliases (file_unique_id, content_hash) VALUES (?, ?)",
+                    (file_unique_id, content_hash)
+                )
+            self._trim(conn)
+            conn.commit()
+
+    def _trim(self, conn):
+        count = conn.execute("SELECT COUNT(*) FROM documents").fetchone()[0]
+        overflow = count - self.max_rows
+        if overflow > 0:
+            conn.execute(
+                "DELETE FROM documents WHERE content_hash IN "
+                "(SELECT content_hash FROM documents ORDER BY last_used ASC LIMIT ?)",
+                (overflow,)
+            )
+            conn.execute("DELETE FROM file_aliases WHERE content_hash NOT IN (SELECT content_hash FROM documents)")
+            conn.execute("DELETE FROM document_links WHERE content_hash NOT IN (SELECT content_hash FROM documents)")
+
+    def _linked(self, content_hash: str, conversation_id: str) -> bool:
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT 1 FROM document_links WHERE content_hash = ? AND conversation_id = ?",
+                (content_hash, str(conversation_id))
+            ).fetchone()
+        return row is not None
+
+    def _link(self, content_hash: str, conversation_id: str):
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "INSERT OR IGNORE INTO document_links (content_hash, conversation_id) VALUES (?, ?)",
+                (content_hash, str(conversation_id))
+            )
+            conn.commit()
+
+    def key_lock(self, content_hash: str) -> asyncio.Lock:
+        """同一份內容共用的鎖（沒有人持有時自動釋放）"""
+        lock = self._key_locks.get(content_hash)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._key_locks[content_hash] = lock
+        return lock
+
+    async def lookup(self, content_hash: str = None, file_unique_id: str = None):
+        """以內容雜湊或 file_unique_id 查詢；未命中回傳 None（讀取失敗也視為未命中）"""
+        try:
+            entry = await run_blocking(self._lookup, content_hash, file_unique_id)
+        except Exception as e:
+            print(f"⚠️ 文件快取讀取失敗：{e}")
+            entry = None
+        return entry
+
+    async def store(self, content_hash: str, file_unique_id: str = None, **fields):
+        """更新部分欄位（object_name、uploaded、extraction、summary），並記錄 file_unique_id 對應"""
+        try:
+            await run_blocking(self._store, content_hash, fields, file_unique_id)
+        except Exception as e:
+            print(f"⚠️ 文件快取寫入失敗：{e}")
+
+    async def linked(self, content_hash: str, conversation_id: str) -> bool:
+        """此對話是否已存過這份文件（讀取失敗視為尚未存過）"""
+        try:
+            return await run_blocking(self._linked, content_hash, conversation_id)
+        except Exception as e:
+            print(f"⚠️ 文件快取讀取失敗：{e}")
+            return False
+
+    async def link(self, content_hash: str, conversation_id: str):
+        """記錄此對話已存過這份文件"""
+        try:
+            await run_blocking(self._link, content_hash, conversation_id)
+        except Exception as e:
+            print(f"⚠️ 文件快取寫入失敗：{e}")
+
+    def record(self, hit: bool):
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0
+        }
+
+
+document_cache = DocumentCache()
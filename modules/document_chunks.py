@@ -0,0 +1,49 @@
+import os
+import re
+
+# 文件切塊設定：每塊字數、相鄰兩塊重疊的字數、索引的字數上限、每次嵌入請求的塊數、召回的塊數
+DOCUMENT_CHUNK_CHARS = int(os.getenv("DOCUMENT_CHUNK_CHARS", "500"))
+DOCUMENT_CHUNK_OVERLAP = int(os.getenv("DOCUMENT_CHUNK_OVERLAP", "100"))
+DOCUMENT_INDEX_MAX_CHARS = int(os.getenv("DOCUMENT_INDEX_MAX_CHARS", "200000"))
+DOCUMENT_EMBED_BATCH = int(os.getenv("DOCUMENT_EMBED_BATCH", "64"))
+DOCUMENT_CHUNK_TOP_K = int(os.getenv("DOCUMENT_CHUNK_TOP_K", "3"))
+
+# 優先在段落、句尾處切開（中英文標點）
+_BREAKS = re.compile(r"\n\s*\n|[。！？；!?;.]\s*|\n")
+_WHITESPACE = re.compile(r"[ \t\r\f\v]+")
+
+
+def document_namespace(conversation_id: str) -> str:
+    """文件塊在本機向量索引中的分區（與對話記憶分開）"""
+    return f"documents_{conversation_id}"
+
+
+def chunk_key(content_hash: str, index: int) -> str:
+    return f"{content_hash}:{index}"
+
+
+def split_into_chunks(text: str, size: int = DOCUMENT_CHUNK_CHARS, overlap: int = DOCUMENT_CHUNK_OVERLAP) -> list:
+    """把文字切成彼此重疊的塊，盡量在句尾切開
+
+    每塊最多 size 字；下一塊從上一塊結尾往前 overlap 字開始，句子跨塊時仍能完整檢索。
+    """
+    text = _WHITESPACE.sub(" ", text).strip()
+    if not text:
+        return []
+    overlap = min(overlap, size // 2)
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = min(start + size, len(text))
+        if end < len(text):
+            # 在後半段找最後一個斷點，找不到就硬切
+            breaks = [match.end() for match in _BREAKS.finditer(text, start + size // 2, end)]
+            if breaks:
+                end = breaks[-1]
+        chunk = text[start:end].strip()
+        if chunk:
+            chunks.append(chunk)
+        if end >= len(text):
+            break
+        start = max(end - overlap, start + 1)
+    return chunks
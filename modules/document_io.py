@@ -0,0 +1,162 @@
+import os
+import time
+import base64
+import hashlib
+import tempfile
+import httpx
+from modules import clients
+
+# 文件下載：小於此大小的檔案完全在記憶體中處理，超過才暫存到磁碟
+DOCUMENT_SPILL_BYTES = int(os.getenv("DOCUMENT_SPILL_BYTES", str(16 * 1024 * 1024)))
+DOCUMENT_TEMP_DIR = os.getenv("DOCUMENT_TEMP_DIR", "temp")  # 改為 temp，避免 /tmp 權限問題
+# 超過此大小改用 TUS 分段續傳上傳（Supabase 要求每段 6MB）
+STORAGE_RESUMABLE_THRESHOLD = int(os.getenv("STORAGE_RESUMABLE_THRESHOLD", str(6 * 1024 * 1024)))
+TUS_CHUNK_SIZE = 6 * 1024 * 1024
+TUS_MAX_RETRIES = int(os.getenv("TUS_MAX_RETRIES", "3"))
+
+
+class _BytesSink:
+    """只保留寫入的 bytes 參照，不另外複製（搭配 File.download_to_memory 使用）"""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data) -> int:
+        self.chunks.append(data)
+        return len(data)
+
+    def getvalue(self) -> bytes:
+        return self.chunks[0] if len(self.chunks) == 1 else b"".join(self.chunks)
+
+
+class DocumentSource:
+    """下載後的文件：小檔案為記憶體中的 bytes（data），大檔案為唯一命名的暫存檔（path）
+
+    擷取與上傳共用同一份內容，close() 時刪除暫存檔。
+    """
+
+    def __init__(self, data: bytes = None, path: str = None):
+        self.data = data
+        self.path = path
+        self.size = len(data) if data is not None else os.path.getsize(path)
+
+    @property
+    def payload(self):
+        """交給擷取器的內容（bytes 或檔案路徑）"""
+        return self.data if self.data is not None else self.path
+
+    def read_range(self, offset: int, length: int) -> bytes:
+        if self.data is not None:
+            return self.data[offset:offset + length]
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            return f.read(length)
+
+    def sha256(self) -> str:
+        """內容雜湊（同一份內容不論檔名都得到相同的值；大檔案逐段讀取）"""
+        digest = hashlib.sha256()
+        if self.data is not None:
+            digest.update(self.data)
+        else:
+            with open(self.path, "rb") as f:
+                for block in iter(lambda: f.read(1024 * 1024), b""):
+                    digest.update(block)
+        return digest.hexdigest()
+
+    def close(self):
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+        self.data = None
+
+
+async def download_document(file_obj, size: int = None, prefix: str = "") -> DocumentSource:
+    """下載 Telegram 檔案：小檔案留在記憶體，超過 DOCUMENT_SPILL_BYTES 才寫入暫存檔"""
+    size = size if size is not None else file_obj.file_size
+    if size is not None and size <= DOCUMENT_SPILL_BYTES:
+        sink = _BytesSink()
+        await file_obj.download_to_memory(sink)
+        return DocumentSource(data=sink.getvalue())
+
+    os.makedirs(DOCUMENT_TEMP_DIR, exist_ok=True)
+    fd, path = tempfile.mkstemp(prefix=prefix, dir=DOCUMENT_TEMP_DIR)
+    os.close(fd)
+    try:
+        await file_obj.download_to_drive(path)
+    except Exception:
+        os.remove(path)
+        raise
+    return DocumentSource(path=path)
+
+
+def is_duplicate_object(error: Exception) -> bool:
+    """Storage 回報物件已存在（一般上傳回 Duplicate，TUS 建立上傳回 409）"""
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code == 409
+    message = str(error)
+    return "Duplicate" in message or "already exists" in message
+
+
+def _tus_metadata(values: dict) -> str:
+    return ",".join(f"{key} {base64.b64encode(value.encode('utf-8')).decode('ascii')}" for key, value in values.items())
+
+
+def resumable_upload(bucket: str, object_name: str, source: DocumentSource, content_type: str):
+    """以 TUS 協定分段上傳；單段失敗時查詢伺服器已收到的位置後續傳（同步，於執行緒池執行）"""
+    session = clients.supabase.storage.session
+    tus_headers = {"Tus-Resumable": "1.0.0"}
+    response = session.post("upload/resumable", headers={
+        **tus_headers,
+        "Upload-Length": str(source.size),
+        "Upload-Metadata": _tus_metadata({"bucketName": bucket, "objectName": object_name, "contentType": content_type}),
+        "x-upsert": "false"
+    })
+    response.raise_for_status()
+    location = response.headers["Location"]
+
+    offset = 0
+    failures = 0
+    while offset < source.size:
+        try:
+            response = session.patch(location, headers={
+                **tus_headers,
+                "Upload-Offset": str(offset),
+                "Content-Type": "application/offset+octet-stream"
+            }, content=source.read_range(offset, TUS_CHUNK_SIZE))
+            response.raise_for_status()
+            offset = int(response.headers["Upload-Offset"])
+            failures = 0
+        except httpx.HTTPError as e:
+            failures += 1
+            if failures > TUS_MAX_RETRIES:
+                raise
+            print(f"⚠️ 分段上傳失敗（位置 {offset}），{failures} 秒後續傳: {e}")
+            time.sleep(failures)
+            head = session.head(location, headers=tus_headers)
+            head.raise_for_status()
+            offset = int(head.headers["Upload-Offset"])
+
+
+def upload_document(bucket: str, object_name: str, source: DocumentSource, content_type: str = "application/octet-stream"):
+    """上傳到 Supabase Storage：小檔案一次上傳，大檔案分段續傳（同步，於執行緒池執行）
+
+    物件已存在時不重傳，回傳 False；實際上傳回傳 True。
+    """
+    try:
+        _upload(bucket, object_name, source, content_type)
+    except Exception as e:
+        if is_duplicate_object(e):
+            return False
+        raise
+    return True
+
+
+def _upload(bucket: str, object_name: str, source: DocumentSource, content_type: str):
+    if source.size > STORAGE_RESUMABLE_THRESHOLD:
+        resumable_upload(bucket, object_name, source, content_type)
+        return
+    storage = clients.supabase.storage.from_(bucket)
+    if source.data is not None:
+        storage.upload(object_name, bytes(source.data), {"content-type": content_type})
+    else:
+        with open(source.path, "rb") as f:
+            storage.upload(object_name, f, {"content-type": content_type})
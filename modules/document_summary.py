@@ -0,0 +1,97 @@
+import os
+import asyncio
+from modules.document_chunks import split_into_chunks
+
+# 文件摘要設定：模型、每段字數、同時進行的摘要請求數、各階段的輸出長度
+DOCUMENT_SUMMARY_MODEL = os.getenv("DOCUMENT_SUMMARY_MODEL", "gpt-4o-mini")
+DOCUMENT_SUMMARY_SECTION_CHARS = int(os.getenv("DOCUMENT_SUMMARY_SECTION_CHARS", "6000"))
+DOCUMENT_SUMMARY_CONCURRENCY = int(os.getenv("DOCUMENT_SUMMARY_CONCURRENCY", "8"))
+DOCUMENT_SUMMARY_SECTION_MAX_TOKENS = int(os.getenv("DOCUMENT_SUMMARY_SECTION_MAX_TOKENS", "200"))
+DOCUMENT_SUMMARY_MAX_TOKENS = int(os.getenv("DOCUMENT_SUMMARY_MAX_TOKENS", "300"))
+# 分段摘要合計超過此字數時，先分組合併再產生最終摘要
+DOCUMENT_SUMMARY_REDUCE_MAX_CHARS = int(os.getenv("DOCUMENT_SUMMARY_REDUCE_MAX_CHARS", "12000"))
+
+
+async def _complete(client, prompt: str, max_tokens: int) -> str:
+    response = await client.chat.completions.create(
+        model=DOCUMENT_SUMMARY_MODEL,
+        messages=[{"role": "user", "content": prompt}],
+        max_tokens=max_tokens
+    )
+    return response.choices[0].message.content
+
+
+async def _map_sections(client, sections: list, semaphore: asyncio.Semaphore, on_partial=None) -> list:
+    """同時摘要各段（受 semaphore 限制），完成一段就回報一段；失敗的段落略過"""
+    total = len(sections)
+
+    async def summarize(index: int, section: str):
+        async with semaphore:
+            prompt = f"以下是一份文件的第 {index + 1}/{total} 段，請條列摘要這一段的重點：\n\n{section}"
+            return index, await _complete(client, prompt, DOCUMENT_SUMMARY_SECTION_MAX_TOKENS)
+
+    partials = [None] * total
+    failures = 0
+    for future in asyncio.as_completed([summarize(i, section) for i, section in enumerate(sections)]):
+        try:
+            index, summary = await future
+        except Exception as e:
+            failures += 1
+            print(f"⚠️ 分段摘要失敗（{failures}/{total}）：{e}")
+            continue
+        partials[index] = summary
+        if on_partial is not None:
+            try:
+                await on_partial(index, total, summary)
+            except Exception as e:
+                print(f"⚠️ 分段摘要回報失敗：{e}")
+
+    partials = [summary for summary in partials if summary]
+    if not partials:
+        raise RuntimeError("所有分段摘要都失敗")
+    return partials
+
+
+async def _reduce(client, partials: list, semaphore: asyncio.Semaphore) -> str:
+    """把分段摘要合併成最終摘要；太長時先分組合併（各組同時進行）"""
+    while sum(len(summary) for summary in partials) > DOCUMENT_SUMMARY_REDUCE_MAX_CHARS and len(partials) > 1:
+        groups = []
+        current = []
+        length = 0
+        for summary in partials:
+            if current and length + len(summary) > DOCUMENT_SUMMARY_REDUCE_MAX_CHARS:
+                groups.append(current)
+                current, length = [], 0
+            current.append(summary)
+            length += len(summary)
+        groups.append(current)
+        if len(groups) == len(partials):
+            break
+
+        async def combine(group):
+            async with semaphore:
+                joined = "\n\n".join(group)
+                return await _complete(client, f"請把以下幾段文件摘要合併成一段重點摘要：\n\n{joined}", DOCUMENT_SUMMARY_SECTION_MAX_TOKENS)
+
+        partials = await asyncio.gather(*(combine(group) for group in groups))
+
+    joined = "\n\n".join(f"【第 {i + 1} 部分】\n{summary}" for i, summary in enumerate(partials))
+    return await _complete(client, f"以下是一份文件依序各部分的摘要，請整合成完整的文件摘要：\n\n{joined}",
+                           DOCUMENT_SUMMARY_MAX_TOKENS)
+
+
+async def summarize_document(client, text: str, on_partial=None, concurrency: int = DOCUMENT_SUMMARY_CONCURRENCY) -> str:
+    """map-reduce 文件摘要
+
+    短文件一次摘要；長文件切成 DOCUMENT_SUMMARY_SECTION_CHARS 字的段落同時摘要（最多 concurrency 個請求），
+    每段完成時呼叫 async on_partial(index, total, summary)，最後合併成一份摘要。
+    """
+    if len(text) <= DOCUMENT_SUMMARY_SECTION_CHARS:
+        return await _complete(client, f"請摘要此文件內容：\n\n{text}", DOCUMENT_SUMMARY_MAX_TOKENS)
+
+    sections = split_into_chunks(text, DOCUMENT_SUMMARY_SECTION_CHARS, overlap=0)
+    semaphore = asyncio.Semaphore(concurrency)
+    partials = await _map_sections(client, sections, semaphore, on_partial)
+    if len(partials) == 1:
+        return partials[0]
+    return await _reduce(client, partials, semaphore)
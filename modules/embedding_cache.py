@@ -0,0 +1,148 @@
+import os
+import re
+import time
+import hashlib
+import sqlite3
+import threading
+from array import array
+from modules.ttl_cache import TTLCache
+from modules.executor import run_blocking
+
+# 嵌入快取設定：記憶體 LRU 容量、SQLite 檔案位置與最大筆數
+EMBEDDING_CACHE_MEMORY_SIZE = int(os.getenv("EMBEDDING_CACHE_MEMORY_SIZE", "2048"))
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", os.path.join("data", "embedding_cache.sqlite3"))
+EMBEDDING_CACHE_MAX_ROWS = int(os.getenv("EMBEDDING_CACHE_MAX_ROWS", "50000"))
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_text(text: str) -> str:
+    """正規化輸入文字（去除首尾空白、合併連續空白），相同內容共用同一個嵌入"""
+    return _WHITESPACE.sub(" ", text).strip()
+
+
+def embedding_key(model: str, text: str) -> str:
+    """以模型名稱與正規化文字計算內容位址"""
+    return hashlib.sha256(f"{model}\0{text}".encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """兩層嵌入快取：記憶體 LRU + 本機 SQLite（float32 儲存，重啟後仍可命中）
+
+    兩層都以 array("f") 保存向量（每維 4 bytes，Python float list 約 32 bytes），
+    只在 get() 回傳時轉成 list。
+    """
+
+    def __init__(self, path: str = EMBEDDING_CACHE_PATH, memory_size: int = EMBEDDING_CACHE_MEMORY_SIZE,
+                 max_rows: int = EMBEDDING_CACHE_MAX_ROWS):
+        self.path = path
+        self.max_rows = max_rows
+        self.memory = TTLCache(maxsize=memory_size)
+        self.disk_hits = 0
+        self.misses = 0
+        self.disk_evictions = 0
+        self._conn = None
+        self._lock = threading.Lock()
+        self._writes_since_trim = 0
+
+    def _connect(self):
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "key TEXT PRIMARY KEY, model TEXT, vector BLOB, last_used REAL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_embeddings_last_used ON embeddings(last_used)")
+        return self._conn
+
+    def _disk_get(self, key: str):
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute("SELECT vector FROM embeddings WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE embeddings SET last_used = ? WHERE key = ?", (time.time(), key))
+            conn.commit()
+        vector = array("f")
+        vector.frombytes(row[0])
+        return vector
+
+    def _disk_put(self, key: str, model: str, vector: array):
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO embeddings (key, model, vector, last_used) VALUES (?, ?, ?, ?)",
+                (key, model, vector.tobytes(), time.time())
+            )
+            self._writes_since_trim += 1
+            # 每寫入一批才檢查一次容量，淘汰最久未使用的項目
+            if self._writes_since_trim >= 100:
+                self._writes_since_trim = 0
+                self._trim(conn)
+            conn.commit()
+
+    def _trim(self, conn):
+        count = conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        overflow = count - self.max_rows
+        if overflow > 0:
+            conn.execute(
+                "DELETE FROM embeddings WHERE key IN "
+                "(SELECT key FROM embeddings ORDER BY last_used ASC LIMIT ?)",
+                (overflow,)
+            )
+            self.disk_evictions += overflow
+
+    async def get(self, model: str, text: str):
+        """查詢快取；未命中回傳 None"""
+        key = embedding_key(model, text)
+        vector = self.memory.get(key)
+        if vector is not None:
+            return vector.tolist()
+
+        try:
+            vector = await run_blocking(self._disk_get, key)
+        except Exception as e:
+            print(f"⚠️ 嵌入快取讀取失敗：{e}")
+            vector = None
+
+        if vector is None:
+            self.misses += 1
+            return None
+
+        self.disk_hits += 1
+        self.memory.set(key, vector)
+        return vector.tolist()
+
+    async def put(self, model: str, text: str, embedding):
+        """寫入兩層快取"""
+        key = embedding_key(model, text)
+        vector = array("f", embedding)
+        self.memory.set(key, vector)
+        try:
+            await run_blocking(self._disk_put, key, model, vector)
+        except Exception as e:
+            print(f"⚠️ 嵌入快取寫入失敗：{e}")
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def stats(self) -> dict:
+        """命中率統計（記憶體命中、磁碟命中、未命中）"""
+        memory_hits = self.memory.hits
+        total = memory_hits + self.disk_hits + self.misses
+        return {
+            "memory_hits": memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (memory_hits + self.disk_hits) / total if total else 0.0,
+            "memory_size": len(self.memory),
+            "disk_evictions": self.disk_evictions
+        }
@@ -0,0 +1,36 @@
+import os
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+# 阻塞 I/O（Supabase 同步客戶端、檔案操作）統一丟到有上限的執行緒池，避免卡住事件循環
+IO_MAX_WORKERS = int(os.getenv("IO_MAX_WORKERS", "32"))
+
+_executor = None
+
+
+def get_executor() -> ThreadPoolExecutor:
+    """取得（必要時建立）共用的 I/O 執行緒池"""
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=IO_MAX_WORKERS, thread_name_prefix="xcg-io")
+    return _executor
+
+
+async def run_blocking(func, *args, **kwargs):
+    """在執行緒池中執行阻塞函式，並在事件循環中等待結果"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_executor(), partial(func, *args, **kwargs))
+
+
+async def execute(query):
+    """非阻塞地執行 Supabase 查詢（query 為尚未 execute 的查詢建構器）"""
+    return await run_blocking(query.execute)
+
+
+def shutdown_executor(wait: bool = True):
+    """關閉執行緒池（程式結束時呼叫）"""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=wait)
+        _executor = None
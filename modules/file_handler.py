@@ -1,84 +1,140 @@
 import os
+import mimetypes
 from telegram import Update
 from telegram.ext import ContextTypes
-from supabase import create_client, Client
-from openai import OpenAI
 from dotenv import load_dotenv
-import PyPDF2
-from docx import Document
+from modules.executor import execute, run_blocking
+from modules import clients
+from modules.text_extraction import extract_text, EXTRACT_MAX_CHARS, EXTRACT_MAX_FILE_BYTES
+from modules.document_io import download_document, upload_document
+from modules.document_cache import document_cache
+from modules.document_chunks import DOCUMENT_INDEX_MAX_CHARS
+from modules.document_summary import summarize_document
+from modules.streaming_reply import StreamingReply
 
 load_dotenv()
 
-SUPABASE_URL = os.getenv("SUPABASE_URL")
-SUPABASE_KEY = os.getenv("SUPABASE_KEY")
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 BUCKET_NAME = "xiaochenguang"
 
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
-openai_client = OpenAI(api_key=OPENAI_API_KEY)
-
-async def handle_file(update: Update, context: ContextTypes.DEFAULT_TYPE, conversation_id: str = None):
+# 與 bot.py 共用同一組客戶端與連線池
+supabase = clients.supabase
+openai_client = clients.openai_client
+
+async def _reply_cached(update: Update, conversation_id: str, document, entry: dict, ingest=None) -> str:
+    """相同內容先前已處理過：直接回覆快取的摘要，此對話尚未存過才寫入記憶"""
+    await update.message.reply_text(f"♻️ 這份文件先前已分析過，直接使用之前的結果：\n{entry['summary']}")
+    await _save_memory(conversation_id, entry["content_hash"], document.file_name, entry["extraction"]["text"], ingest)
+    return "文件處理完成！"
+
+
+async def _save_memory(conversation_id: str, content_hash: str, file_name: str, text: str, ingest=None):
+    """寫入文件記憶並建立檢索索引；同一對話重複傳送同一份文件只存一筆"""
+    if await document_cache.linked(content_hash, conversation_id):
+        return
+    if ingest is not None:
+        try:
+            await ingest(conversation_id, content_hash, file_name, text)
+        except Exception as e:
+            # 索引失敗不影響摘要與記憶寫入
+            print(f"❌ 文件索引失敗：{e}")
+    await execute(supabase.table("xiaochenguang_memories").insert({
+        "conversation_id": conversation_id,
+        "file_name": file_name,
+        "document_content": text[:EXTRACT_MAX_CHARS],
+        "created_at": "now()",
+        "platform": "telegram"
+    }))
+    await document_cache.link(content_hash, conversation_id)
+
+
+def _is_complete(entry) -> bool:
+    return bool(entry and entry["summary"] and entry["extraction"] and entry["uploaded"])
+
+
+async def handle_file(update: Update, context: ContextTypes.DEFAULT_TYPE, conversation_id: str = None, ingest=None):
+    """處理使用者上傳的文件
+
+    ingest 為 async (conversation_id, content_hash, file_name, text) 回呼，
+    用來把全文切塊建立檢索索引（由 bot.py 提供嵌入與索引）。
+    """
     document = update.message.document
     if not document:
         await update.message.reply_text("❌ 沒有收到檔案")
         return "沒有收到檔案"
 
-    file_path = os.path.join("temp", f"{conversation_id}_{document.file_name}")  # 改為 temp，避免 /tmp 權限問題
-    os.makedirs("temp", exist_ok=True)
+    if document.file_size and document.file_size > EXTRACT_MAX_FILE_BYTES:
+        message = f"檔案過大（上限 {EXTRACT_MAX_FILE_BYTES // 1024 // 1024}MB）"
+        await update.message.reply_text(f"❌ {message}")
+        return message
 
+    source = None
     try:
-        # 下載文件
+        # 同一個 Telegram 檔案再次傳來：查一次快取即可，不需下載
+        file_unique_id = getattr(document, "file_unique_id", None)
+        if file_unique_id:
+            entry = await document_cache.lookup(file_unique_id=file_unique_id)
+            if _is_complete(entry):
+                document_cache.record(hit=True)
+                return await _reply_cached(update, conversation_id, document, entry, ingest)
+
+        # 下載文件（一般大小的文件只在記憶體中處理，擷取與上傳共用同一份內容）
         file_obj = await context.bot.get_file(document.file_id)
-        await file_obj.download_to_drive(file_path)
+        source = await download_document(file_obj, document.file_size, prefix=f"{conversation_id}_")
         await update.message.reply_text(f"✅ 檔案已下載: {document.file_name}")
 
-        # 提取文件內容
-        file_content = ""
-        file_ext = os.path.splitext(document.file_name)[1].lower()
-        if file_ext == '.pdf':
-            with open(file_path, 'rb') as f:
-                reader = PyPDF2.PdfReader(f)
-                for page in reader.pages:
-                    file_content += page.extract_text() or ""  # 處理空頁
-        elif file_ext == '.docx':
-            doc = Document(file_path)
-            for para in doc.paragraphs:
-                file_content += para.text + "\n"
-        else:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                file_content = f.read()
-
-        file_content = file_content[:10000]  # 限制長度
-
-        # 上傳到 Supabase Storage
-        with open(file_path, "rb") as f:
-            supabase.storage.from_(BUCKET_NAME).upload(f"users/{conversation_id}/{document.file_name}", f)
-        await update.message.reply_text(f"📤 檔案已上傳到 Supabase bucket: {BUCKET_NAME}")
-
-        # OpenAI 摘要
-        response = openai_client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[{"role": "user", "content": f"請摘要此文件內容：\n\n{file_content}"}],
-            max_tokens=300
-        ).choices[0].message.content
+        # 以內容雜湊辨識相同文件（不同使用者、不同檔名也共用結果）
+        content_hash = await run_blocking(source.sha256)
+        file_name = os.path.basename(document.file_name or "document")
+        file_ext = os.path.splitext(file_name)[1].lower()
+        async with document_cache.key_lock(content_hash):
+            entry = await document_cache.lookup(content_hash=content_hash)
+            document_cache.record(hit=_is_complete(entry))
+            if _is_complete(entry):
+                await document_cache.store(content_hash, file_unique_id)
+                return await _reply_cached(update, conversation_id, document, entry, ingest)
+            entry = entry or {}
+
+            # 提取文件內容（子程序中逐頁擷取，達到字數或時間上限即停止）
+            # 全文（最多 DOCUMENT_INDEX_MAX_CHARS 字）用於摘要與檢索索引，記憶列只存前 EXTRACT_MAX_CHARS 字
+            extracted = entry.get("extraction")
+            if extracted is None:
+                extracted = await extract_text(source.payload, file_ext, max_chars=DOCUMENT_INDEX_MAX_CHARS)
+                await document_cache.store(content_hash, file_unique_id, extraction=extracted)
+            if extracted["truncated"]:
+                await update.message.reply_text(f"✂️ 文件超過 {DOCUMENT_INDEX_MAX_CHARS} 字，只索引前 {DOCUMENT_INDEX_MAX_CHARS} 字")
+            elif extracted["timed_out"]:
+                await update.message.reply_text(f"⏳ 文件擷取時間過長，只分析前 {extracted['units']} 頁／段")
+
+            # 上傳到 Supabase Storage（物件名稱以內容雜湊決定，相同內容只存一份，已存在就不重傳）
+            if not entry.get("uploaded"):
+                object_name = f"documents/{content_hash[:2]}/{content_hash}{file_ext}"
+                content_type = document.mime_type or mimetypes.guess_type(file_name)[0] or "application/octet-stream"
+                await run_blocking(upload_document, BUCKET_NAME, object_name, source, content_type)
+                await document_cache.store(content_hash, object_name=object_name, uploaded=True)
+            await update.message.reply_text(f"📤 檔案已上傳到 Supabase bucket: {BUCKET_NAME}")
+
+            # OpenAI 摘要（長文件分段同時摘要，每段完成就更新進度訊息，最後合併）
+            progress = StreamingReply(update.message)
+
+            async def on_partial(index: int, total: int, summary: str):
+                await progress.feed(f"🧩 第 {index + 1}/{total} 段摘要：\n{summary}\n\n")
+
+            response = await summarize_document(openai_client, extracted["text"], on_partial=on_partial)
+            if progress.text:
+                await progress.finish(progress.text.strip())
+            await document_cache.store(content_hash, summary=response)
         await update.message.reply_text(f"🧠 分析結果：\n{response}")
 
-        # 儲存到資料表
-        supabase.table("xiaochenguang_memories").insert({
-            "conversation_id": conversation_id,
-            "file_name": document.file_name,
-            "document_content": file_content,
-            "created_at": "now()",
-            "platform": "telegram"
-        }).execute()
+        # 儲存到資料表並建立檢索索引
+        await _save_memory(conversation_id, content_hash, document.file_name, extracted["text"], ingest)
 
         return "文件處理完成！"
     except Exception as e:
         await update.message.reply_text(f"❌ 處理失敗: {str(e)}")
         return f"錯誤: {str(e)}"
     finally:
-        if os.path.exists(file_path):
-            os.remove(file_path)
+        if source is not None:
+            source.close()
 
 async def download_full_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -0,0 +1,179 @@
+import os
+import json
+import time
+import asyncio
+from datetime import datetime
+from modules.executor import run_blocking
+
+# 背景工作佇列設定
+JOB_QUEUE_WORKERS = int(os.getenv("JOB_QUEUE_WORKERS", "32"))
+JOB_QUEUE_MAXSIZE = int(os.getenv("JOB_QUEUE_MAXSIZE", "1000"))
+JOB_MAX_RETRIES = int(os.getenv("JOB_MAX_RETRIES", "3"))
+JOB_RETRY_BACKOFF = float(os.getenv("JOB_RETRY_BACKOFF", "1.0"))
+DEAD_LETTER_PATH = os.getenv("DEAD_LETTER_PATH", os.path.join("data", "dead_letters.jsonl"))
+
+
+class Job:
+    __slots__ = ("name", "func", "args", "kwargs", "retries", "attempt", "enqueued_at")
+
+    def __init__(self, name, func, args, kwargs, retries):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.retries = retries
+        self.attempt = 0
+        self.enqueued_at = time.monotonic()
+
+
+class JobQueue:
+    """有上限的程序內背景工作佇列
+
+    - submit() 在佇列滿時等待（背壓），讓來源自然放慢
+    - 失敗的工作以指數退避重試，超過重試次數寫入 dead-letter 檔
+    - stop() 會先處理完佇列與等待中的重試再結束 worker
+    """
+
+    def __init__(self, name: str = "jobs", workers: int = JOB_QUEUE_WORKERS, maxsize: int = JOB_QUEUE_MAXSIZE,
+                 max_retries: int = JOB_MAX_RETRIES, backoff: float = JOB_RETRY_BACKOFF,
+                 dead_letter_path: str = DEAD_LETTER_PATH):
+        self.name = name
+        self.workers = workers
+        self.maxsize = maxsize
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.dead_letter_path = dead_letter_path
+        self.processed = 0
+        self.failed_attempts = 0
+        self.retried = 0
+        self.dead = 0
+        self.in_flight = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self._total_lag = 0.0
+        self._started_jobs = 0
+        self._queue = None
+        self._tasks = []
+        self._retry_tasks = set()
+
+    def start(self):
+        if self._tasks:
+            return
+        self._queue = asyncio.Queue(maxsize=self.maxsize)
+        self._tasks = [asyncio.ensure_future(self._worker()) for _ in range(self.workers)]
+
+    async def submit(self, name: str, func, *args, retries: int = None, **kwargs):
+        """加入工作；func(*args, **kwargs) 必須回傳 coroutine。佇列已滿時等待空位"""
+        job = Job(name, func, args, kwargs, self.max_retries if retries is None else retries)
+        if self._queue is None:
+            # 尚未啟動（例如單獨呼叫）時直接執行
+            await self._run(job)
+            return
+        await self._queue.put(job)
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            try:
+                await self._run(job)
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, job: Job):
+        lag = time.monotonic() - job.enqueued_at
+        self.last_lag = lag
+        self.max_lag = max(self.max_lag, lag)
+        self._total_lag += lag
+        self._started_jobs += 1
+        self.in_flight += 1
+        job.attempt += 1
+        try:
+            await job.func(*job.args, **job.kwargs)
+            self.processed += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.failed_attempts += 1
+            if job.attempt <= job.retries and self._queue is not None:
+                delay = self.backoff * 2 ** (job.attempt - 1)
+                print(f"⚠️ {self.name} 工作 {job.name} 失敗（第 {job.attempt} 次），{delay:.1f}s 後重試: {e}")
+                self.retried += 1
+                task = asyncio.ensure_future(self._requeue(job, delay))
+                self._retry_tasks.add(task)
+                task.add_done_callback(self._retry_tasks.discard)
+            else:
+                await self._dead_letter(job, e)
+        finally:
+            self.in_flight -= 1
+
+    async def _requeue(self, job: Job, delay: float):
+        await asyncio.sleep(delay)
+        job.enqueued_at = time.monotonic()
+        await self._queue.put(job)
+
+    async def _dead_letter(self, job: Job, error: Exception):
+        self.dead += 1
+        print(f"❌ {self.name} 工作 {job.name} 放棄（共嘗試 {job.attempt} 次）: {error}")
+        record = {
+            "time": datetime.now().isoformat(),
+            "queue": self.name,
+            "job": job.name,
+            "attempts": job.attempt,
+            "error": repr(error),
+            "args": [repr(arg)[:500] for arg in job.args],
+            "kwargs": {key: repr(value)[:500] for key, value in job.kwargs.items()}
+        }
+
+        def append():
+            directory = os.path.dirname(self.dead_letter_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(self.dead_letter_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+        try:
+            await run_blocking(append)
+        except Exception as e:
+            print(f"❌ 寫入 dead-letter 失敗: {e}")
+
+    async def drain(self):
+        """等待佇列中與排程重試中的工作全部完成"""
+        if self._queue is None:
+            return
+        while True:
+            await self._queue.join()
+            if not self._retry_tasks:
+                break
+            await asyncio.gather(*list(self._retry_tasks), return_exceptions=True)
+
+    async def stop(self, timeout: float = None):
+        """處理完剩餘工作後停止 worker（逾時則放棄剩餘工作）"""
+        if not self._tasks:
+            return
+        try:
+            await asyncio.wait_for(self.drain(), timeout)
+        except asyncio.TimeoutError:
+            print(f"⚠️ {self.name} 關閉逾時，仍有 {self._queue.qsize()} 個工作未處理")
+        for task in list(self._retry_tasks) + self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, *self._retry_tasks, return_exceptions=True)
+        self._tasks = []
+        self._queue = None
+
+    def depth(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def stats(self) -> dict:
+        return {
+            "depth": self.depth(),
+            "in_flight": self.in_flight,
+            "waiting_retry": len(self._retry_tasks),
+            "workers": self.workers,
+            "processed": self.processed,
+            "failed_attempts": self.failed_attempts,
+            "retried": self.retried,
+            "dead": self.dead,
+            "last_lag": round(self.last_lag, 3),
+            "avg_lag": round(self._total_lag / self._started_jobs, 3) if self._started_jobs else 0.0,
+            "max_lag": round(self.max_lag, 3)
+        }
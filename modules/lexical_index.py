@@ -0,0 +1,129 @@
+import os
+import re
+import math
+from collections import Counter, OrderedDict
+from modules.ttl_cache import TTLCache
+
+# 關鍵字索引設定：每個對話保留的文件數、同時保留在記憶體中的對話數
+LEXICAL_INDEX_MAX_DOCS = int(os.getenv("LEXICAL_INDEX_MAX_DOCS", "2000"))
+LEXICAL_INDEX_MAX_CONVERSATIONS = int(os.getenv("LEXICAL_INDEX_MAX_CONVERSATIONS", "500"))
+
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+# 英數字詞、或連續的中日韓字元
+_TOKEN_RUNS = re.compile(r"[0-9a-z]+|[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]+")
+
+
+def tokenize(text: str) -> list:
+    """中文同時切成單字與字元二元組，英數字以整個詞為單位
+
+    單字讓只有一個字的查詢（例如「貓」）也能命中；二元組讓多字詞的相鄰字元分數較高。
+    """
+    tokens = []
+    for run in _TOKEN_RUNS.findall(text.lower()):
+        if run[0].isascii():
+            tokens.append(run)
+        else:
+            tokens.extend(run)
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+
+class ConversationLexicalIndex:
+    """單一對話的倒排索引（BM25 評分），超過文件上限時淘汰最早加入的文件"""
+
+    def __init__(self, max_docs: int = LEXICAL_INDEX_MAX_DOCS):
+        self.max_docs = max_docs
+        self.loaded = False
+        self.docs = OrderedDict()  # key -> (長度, 詞頻 Counter, payload)
+        self.postings = {}  # token -> {key: tf}
+        self.total_length = 0
+
+    def __len__(self):
+        return len(self.docs)
+
+    def __contains__(self, key):
+        return key in self.docs
+
+    def add(self, key: str, text: str, payload: dict, replace: bool = True):
+        if key in self.docs:
+            if not replace:
+                return
+            self.remove(key)
+
+        counts = Counter(tokenize(text))
+        length = sum(counts.values())
+        self.docs[key] = (length, counts, payload)
+        self.total_length += length
+        for token, tf in counts.items():
+            self.postings.setdefault(token, {})[key] = tf
+
+        while len(self.docs) > self.max_docs:
+            self.remove(next(iter(self.docs)))
+
+    def remove(self, key: str):
+        doc = self.docs.pop(key, None)
+        if doc is None:
+            return
+        length, counts, _ = doc
+        self.total_length -= length
+        for token in counts:
+            posting = self.postings.get(token)
+            if posting is not None:
+                posting.pop(key, None)
+                if not posting:
+                    del self.postings[token]
+
+    def search(self, query: str, k: int = 3) -> list:
+        """回傳 BM25 分數最高的 k 筆 payload（附 score）"""
+        if not self.docs:
+            return []
+        n_docs = len(self.docs)
+        avg_length = self.total_length / n_docs if n_docs else 0.0
+        scores = {}
+        for token in set(tokenize(query)):
+            posting = self.postings.get(token)
+            if not posting:
+                continue
+            idf = math.log(1 + (n_docs - len(posting) + 0.5) / (len(posting) + 0.5))
+            for key, tf in posting.items():
+                length = self.docs[key][0]
+                norm = tf + BM25_K1 * (1 - BM25_B + BM25_B * length / avg_length) if avg_length else tf + BM25_K1
+                scores[key] = scores.get(key, 0.0) + idf * tf * (BM25_K1 + 1) / norm
+
+        best = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+        return [dict(self.docs[key][2], score=score) for key, score in best]
+
+
+class LexicalIndex:
+    """以 conversation_id 分區的倒排索引集合，記憶體中的對話數以 LRU 限制"""
+
+    def __init__(self, max_conversations: int = LEXICAL_INDEX_MAX_CONVERSATIONS,
+                 max_docs: int = LEXICAL_INDEX_MAX_DOCS):
+        self.max_docs = max_docs
+        self._indexes = TTLCache(maxsize=max_conversations)
+
+    def get(self, conversation_id: str) -> ConversationLexicalIndex:
+        """取得已存在的索引（不存在回傳 None）"""
+        return self._indexes.get(conversation_id)
+
+    def get_or_create(self, conversation_id: str) -> ConversationLexicalIndex:
+        index = self._indexes.get(conversation_id)
+        if index is None:
+            index = ConversationLexicalIndex(self.max_docs)
+            self._indexes.set(conversation_id, index)
+        return index
+
+    def add(self, conversation_id: str, key: str, text: str, payload: dict):
+        """增量加入文件；尚未建立索引的對話略過（之後回填時會從資料庫載入）"""
+        index = self._indexes.get(conversation_id)
+        if index is not None:
+            index.add(key, text, payload)
+
+    def search(self, conversation_id: str, query: str, k: int = 3) -> list:
+        index = self._indexes.get(conversation_id)
+        return index.search(query, k) if index is not None else []
+
+    def stats(self) -> dict:
+        return dict(self._indexes.stats(), documents=sum(len(index) for index in self._indexes.values()))
@@ -0,0 +1,87 @@
+import asyncio
+
+
+class MicroBatcher:
+    """把短時間內的多個請求合併成一批處理
+
+    submit() 會等到湊滿 max_batch 筆、或第一筆加入後經過 max_wait 秒，
+    再以 process(items) 一次處理整批；process 必須回傳與 items 等長、順序相同的結果。
+    整批失敗時改為逐筆重新處理，只有造成失敗的那一筆會收到例外。
+    """
+
+    def __init__(self, process, max_batch: int = 64, max_wait: float = 0.05, name: str = "batch"):
+        self.process = process
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.name = name
+        self.batches = 0
+        self.items = 0
+        self.retried_batches = 0
+        self._pending = []  # [(item, future)]
+        self._timer = None
+        self._running = set()
+
+    async def submit(self, item):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((item, future))
+        if len(self._pending) >= self.max_batch:
+            self._flush_pending()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._flush_pending)
+        return await future
+
+    def _flush_pending(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.ensure_future(self._run(batch))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _run(self, batch):
+        self.batches += 1
+        self.items += len(batch)
+        try:
+            results = await self._process([item for item, _ in batch])
+        except Exception as e:
+            if len(batch) == 1:
+                results = [e]
+            else:
+                # 找出是哪一筆造成失敗：逐筆重新處理，其他呼叫者不受影響
+                self.retried_batches += 1
+                print(f"⚠️ {self.name} 批次失敗，改為逐筆處理 {len(batch)} 筆：{e}")
+                results = await asyncio.gather(*(self._process_one(item) for item, _ in batch), return_exceptions=True)
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    async def _process(self, items: list) -> list:
+        results = await self.process(items)
+        if len(results) != len(items):
+            raise RuntimeError(f"{self.name} 批次結果數量不符：{len(results)} != {len(items)}")
+        return results
+
+    async def _process_one(self, item):
+        return (await self._process([item]))[0]
+
+    async def flush(self):
+        """立即處理目前累積的請求並等待所有批次完成"""
+        self._flush_pending()
+        if self._running:
+            await asyncio.gather(*list(self._running), return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "avg_batch": round(self.items / self.batches, 2) if self.batches else 0.0,
+            "retried_batches": self.retried_batches,
+            "pending": len(self._pending)
+        }
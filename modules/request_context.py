@@ -0,0 +1,37 @@
+import asyncio
+
+
+class RequestContext:
+    """單一訊息處理期間的記憶化容器
+
+    同一則訊息中相同的嵌入、RPC 與歷史查詢只會執行一次，所有呼叫者共享結果
+    （包含同時進行中的呼叫）。
+    """
+
+    def __init__(self, conversation_id: str):
+        self.conversation_id = conversation_id
+        self.calls = 0
+        self.reuses = 0
+        self._results = {}
+
+    async def memo(self, key, factory):
+        """以 key 記憶 factory() 的結果；factory 為回傳 coroutine 的函式"""
+        task = self._results.get(key)
+        if task is None:
+            self.calls += 1
+            task = asyncio.ensure_future(factory())
+            self._results[key] = task
+        else:
+            self.reuses += 1
+        # shield：單一呼叫者被取消（例如逾時）不應中斷其他人共享的查詢
+        return await asyncio.shield(task)
+
+    def stats(self) -> dict:
+        return {"calls": self.calls, "reuses": self.reuses}
+
+
+async def memoize(ctx, key, factory):
+    """有 RequestContext 時透過它記憶結果，否則直接執行"""
+    if ctx is None:
+        return await factory()
+    return await ctx.memo(key, factory)
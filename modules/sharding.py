@@ -0,0 +1,404 @@
+import os
+import sys
+import json
+import time
+import zlib
+import signal
+import asyncio
+import secrets
+import threading
+import multiprocessing
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing.connection import Client, Listener
+
+# 分片部署設定：
+# 前端程序接收 Telegram webhook，依 conversation_id 雜湊轉送到 N 個工作程序（本機或其他節點），
+# 同一用戶的記憶體狀態、快取與處理順序都固定在同一個工作程序上。
+SHARD_WORKERS = int(os.getenv("SHARD_WORKERS", str(os.cpu_count() or 2)))
+# 其他節點上的工作程序位址（host:port，逗號分隔）；未設定時由前端在本機啟動 SHARD_WORKERS 個工作程序
+SHARD_WORKER_ADDRESSES = os.getenv("SHARD_WORKER_ADDRESSES", "")
+SHARD_BASE_PORT = int(os.getenv("SHARD_BASE_PORT", "7100"))
+# 工作程序監聽的位址（以 shard-worker 模式在其他節點單獨啟動時使用）
+SHARD_LISTEN = os.getenv("SHARD_LISTEN", "127.0.0.1")
+# IPC 連線的驗證金鑰；跨節點部署時前端與工作程序必須設定相同的值
+SHARD_AUTHKEY = os.getenv("SHARD_AUTHKEY", "")
+SHARD_CONNECT_TIMEOUT = float(os.getenv("SHARD_CONNECT_TIMEOUT", "30"))
+
+_SHUTDOWN = {"__shutdown__": True}
+
+
+def shard_key(update: dict):
+    """從 Telegram update 的 JSON 取出 conversation_id（發送者的 user id，取不到時用 chat id）"""
+    for value in update.values():
+        if not isinstance(value, dict):
+            continue
+        sender = value.get("from")
+        if isinstance(sender, dict) and "id" in sender:
+            return str(sender["id"])
+        chat = value.get("chat") or (value.get("message") or {}).get("chat")
+        if isinstance(chat, dict) and "id" in chat:
+            return str(chat["id"])
+    return None
+
+
+def shard_for(key, shards: int) -> int:
+    """穩定的雜湊分片（不受 PYTHONHASHSEED 影響，所有節點算出相同結果）"""
+    if key is None:
+        return 0
+    return zlib.crc32(str(key).encode("utf-8")) % shards
+
+
+def parse_address(address):
+    if isinstance(address, tuple):
+        return address
+    host, _, port = address.rpartition(":")
+    return host or "127.0.0.1", int(port)
+
+
+def local_addresses(count: int, base_port: int = SHARD_BASE_PORT) -> list:
+    return [("127.0.0.1", base_port + i) for i in range(count)]
+
+
+def configured_addresses() -> list:
+    return [parse_address(item.strip()) for item in SHARD_WORKER_ADDRESSES.split(",") if item.strip()]
+
+
+class ShardRouter:
+    """前端到各工作程序的 IPC 連線；依 conversation_id 選擇分片並轉送 update"""
+
+    def __init__(self, addresses: list, authkey: bytes):
+        self.addresses = addresses
+        self.authkey = authkey
+        self.forwarded = [0] * len(addresses)
+        self.failures = 0
+        self._connections = [None] * len(addresses)
+        self._locks = [threading.Lock() for _ in addresses]
+
+    def _connect(self, index: int, timeout: float = SHARD_CONNECT_TIMEOUT):
+        """連線到工作程序（剛啟動時可能還沒開始監聽，重試到逾時為止）"""
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                return Client(self.addresses[index], authkey=self.authkey)
+            except (ConnectionRefusedError, FileNotFoundError):
+                if time.monotonic() >= deadline:
+                    raise
+                time.sleep(0.2)
+
+    def connect_all(self, timeout: float = SHARD_CONNECT_TIMEOUT):
+        for index in range(len(self.addresses)):
+            with self._locks[index]:
+                if self._connections[index] is None:
+                    self._connections[index] = self._connect(index, timeout)
+
+    def send(self, update: dict) -> int:
+        """轉送 update，回傳分片編號；連線中斷時重新連線一次，仍失敗則拋出例外"""
+        index = shard_for(shard_key(update), len(self.addresses))
+        with self._locks[index]:
+            for attempt in range(2):
+                try:
+                    if self._connections[index] is None:
+                        self._connections[index] = self._connect(index, timeout=1.0 if attempt else SHARD_CONNECT_TIMEOUT)
+                    self._connections[index].send(update)
+                    self.forwarded[index] += 1
+                    return index
+                except (OSError, EOFError):
+                    self.failures += 1
+                    self._connections[index] = None
+                    if attempt:
+                        raise
+        return index
+
+    def close(self, shutdown_workers: bool = False):
+        for index, connection in enumerate(self._connections):
+            if connection is None:
+                continue
+            with self._locks[index]:
+                try:
+                    if shutdown_workers:
+                        connection.send(_SHUTDOWN)
+                    connection.close()
+                except (OSError, EOFError):
+                    pass
+                self._connections[index] = None
+
+    def stats(self) -> dict:
+        return {"forwarded": list(self.forwarded), "failures": self.failures}
+
+
+def make_webhook_handler(router: ShardRouter, path: str, secret_token: str = None):
+    """接收 Telegram webhook 的 HTTP 處理器：驗證路徑與 secret token 後轉送到對應的分片"""
+    expected_path = "/" + path.strip("/")
+
+    class WebhookHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if self.path.rstrip("/") != expected_path:
+                self.send_error(404)
+                return
+            if secret_token and self.headers.get("X-Telegram-Bot-Api-Secret-Token") != secret_token:
+                self.send_error(403)
+                return
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                update = json.loads(self.rfile.read(length))
+            except ValueError:
+                self.send_error(400)
+                return
+            try:
+                router.send(update)
+            except (OSError, EOFError) as e:
+                # 回傳錯誤讓 Telegram 稍後重送
+                print(f"❌ 轉送 update 失敗：{e}")
+                self.send_error(503)
+                return
+            self.send_response(200)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def log_message(self, format, *args):
+            pass
+
+    return WebhookHandler
+
+
+class FrontServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # Telegram 會同時開多條連線推送（見 WEBHOOK_MAX_CONNECTIONS），預設的 backlog 5 太小
+    request_queue_size = 128
+
+
+def start_front_server(router: ShardRouter, listen: str, port: int, path: str, secret_token: str = None):
+    """在背景執行緒啟動前端 HTTP 伺服器，回傳伺服器物件（shutdown() 結束）"""
+    server = FrontServer((listen, port), make_webhook_handler(router, path, secret_token))
+    threading.Thread(target=server.serve_forever, name="shard-front", daemon=True).start()
+    return server
+
+
+async def serve_worker(address, authkey: bytes, handle):
+    """工作程序端：接受前端的 IPC 連線，依收到的順序把每個 update 交給 async handle(update)
+
+    收到關閉訊息或 SIGINT/SIGTERM 時返回。
+    """
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    listener = Listener(parse_address(address), authkey=authkey)
+
+    def read(connection):
+        try:
+            while True:
+                update = connection.recv()
+                if update == _SHUTDOWN:
+                    loop.call_soon_threadsafe(stop.set)
+                    return
+                # 依序排入事件循環，同一條連線上的 update 保持原本的順序
+                asyncio.run_coroutine_threadsafe(handle(update), loop)
+        except (EOFError, OSError):
+            pass
+        finally:
+            connection.close()
+
+    def accept():
+        while not stop.is_set():
+            try:
+                connection = listener.accept()
+            except OSError:
+                return
+            threading.Thread(target=read, args=(connection,), name="shard-ipc", daemon=True).start()
+
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            pass
+    threading.Thread(target=accept, name="shard-accept", daemon=True).start()
+    try:
+        await stop.wait()
+    finally:
+        listener.close()
+
+
+def spawn_workers(target, addresses: list, authkey: bytes, *args) -> list:
+    """在本機以 spawn 啟動工作程序：target(address, authkey, *args)
+
+    工作程序不設為 daemon：文件擷取需要在工作程序中再建立子程序（daemon 程序不允許），
+    因此呼叫端必須在結束時以 stop_workers() 關閉它們。
+    """
+    context = multiprocessing.get_context("spawn")
+    processes = []
+    for index, address in enumerate(addresses):
+        process = context.Process(target=target, args=(address, authkey, *args), name=f"shard-{index}")
+        process.start()
+        processes.append(process)
+    return processes
+
+
+def stop_workers(processes: list, timeout: float):
+    """等待工作程序結束（已送出關閉訊息時會自行結束），逾時仍未結束的強制終止"""
+    deadline = time.monotonic() + timeout
+    for process in processes:
+        process.join(timeout=max(0.0, deadline - time.monotonic()))
+    for process in processes:
+        if process.is_alive():
+            print(f"⚠️ 工作程序 {process.name} 未在 {timeout:.0f} 秒內結束，強制終止")
+            process.terminate()
+    for process in processes:
+        process.join(timeout=5)
+        if process.is_alive():
+            process.kill()
+            process.join()
+
+
+def resolve_authkey() -> bytes:
+    """跨節點時使用 SHARD_AUTHKEY；只在本機啟動工作程序時可以隨機產生"""
+    return (SHARD_AUTHKEY or secrets.token_hex(16)).encode("utf-8")
+
+
+# === 本機自我檢查：python -m modules.sharding --selftest ===
+# 啟動數個工作程序（與正式部署相同，經由 bot.run_shard_worker / _serve_shard 與 Application 處理 update）
+# 與前端 HTTP 伺服器，只把外部服務（Telegram、OpenAI、Supabase）換成替身。
+# 確認同一用戶的 update 都送到同一個工作程序且順序不變、工作程序中可以擷取文件，並回報吞吐量。
+
+# 讓 bot 可以在沒有正式設定的環境中匯入（替身不會真的連線）
+_SELFTEST_ENV = {
+    "BOT_TOKEN": "123456:selftest",
+    "OPENAI_API_KEY": "sk-selftest",
+    "SUPABASE_URL": "http://127.0.0.1:9",
+    "SUPABASE_KEY": "eyJhbGciOiJIUzI1NiJ9.eyJyb2xlIjoic2VsZnRlc3QifQ.selftest",
+    "MESSAGE_DEBOUNCE_WINDOW": "0.05"
+}
+
+
+def _install_selftest_stubs(bot, results, work_seconds: float):
+    """替換 bot 的外部服務：Telegram 的 get_me、OpenAI 連線測試，以及需要 OpenAI / Supabase 的訊息處理"""
+    from types import SimpleNamespace
+    from telegram import User
+    from telegram.ext import ExtBot
+    from modules.text_extraction import extract_text
+
+    async def get_me(self, *args, **kwargs):
+        self._bot_user = User(id=123456, is_bot=True, first_name="selftest", username="selftest_bot")
+        return self._bot_user
+
+    async def create_completion(**kwargs):
+        return None
+
+    ExtBot.get_me = get_me
+    bot.client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create_completion)))
+
+    last_seen = {}
+
+    def record(conversation_id: str, sequence: int, kind: str, ok: bool = True):
+        in_order = sequence > last_seen.get(conversation_id, -1)
+        last_seen[conversation_id] = sequence
+        results.put((conversation_id, sequence, os.getpid(), in_order and ok, kind))
+
+    async def process_messages(conversation_id: str, updates: list):
+        # 模擬一次 GPT / 資料庫往返
+        await asyncio.sleep(work_seconds)
+        for update in updates:
+            record(conversation_id, update.message.message_id, "text")
+
+    async def process_document(update, context):
+        # 真正在工作程序中建立子程序擷取文字（下載與上傳以訊息內的檔名代替）
+        expected = f"selftest {update.message.document.file_name}"
+        extraction = await extract_text(expected.encode("utf-8"), ".txt")
+        record(str(update.effective_user.id), update.message.message_id, "document", extraction["text"] == expected)
+
+    bot.process_messages = process_messages
+    bot.process_document = process_document
+
+
+def _selftest_worker(address, authkey, results, work_seconds):
+    for name, value in _SELFTEST_ENV.items():
+        os.environ.setdefault(name, value)
+    import bot
+    _install_selftest_stubs(bot, results, work_seconds)
+    bot.run_shard_worker(address, authkey)
+
+
+def _selftest_update(user_id: int, sequence: int, update_id: int, document_every: int) -> dict:
+    message = {
+        "message_id": sequence,
+        "date": int(time.time()),
+        "from": {"id": user_id, "is_bot": False, "first_name": "selftest"},
+        "chat": {"id": user_id, "type": "private"}
+    }
+    if document_every and sequence % document_every == document_every - 1:
+        message["document"] = {"file_id": f"file-{update_id}", "file_unique_id": f"unique-{update_id}",
+                               "file_name": f"note-{update_id}.txt"}
+    else:
+        message["text"] = "hi"
+    return {"update_id": update_id, "message": message}
+
+
+def selftest(workers: int = 4, users: int = 40, messages: int = 25, work_seconds: float = 0.005,
+             document_every: int = 10) -> bool:
+    import urllib.request
+    from concurrent.futures import ThreadPoolExecutor
+
+    authkey = resolve_authkey()
+    addresses = local_addresses(workers, base_port=SHARD_BASE_PORT + 500)
+    results = multiprocessing.get_context("spawn").Queue()
+    processes = spawn_workers(_selftest_worker, addresses, authkey, results, work_seconds)
+    router = ShardRouter(addresses, authkey)
+    server = None
+    received = []
+    try:
+        router.connect_all()
+        server = start_front_server(router, "127.0.0.1", 0, "telegram", secret_token="selftest")
+        url = f"http://127.0.0.1:{server.server_address[1]}/telegram"
+
+        def post(update: dict):
+            request = urllib.request.Request(url, data=json.dumps(update).encode("utf-8"), headers={
+                "Content-Type": "application/json",
+                "X-Telegram-Bot-Api-Secret-Token": "selftest"
+            })
+            with urllib.request.urlopen(request) as response:
+                assert response.status == 200
+
+        def send_user(user_id: int):
+            # 同一用戶依序送出（Telegram 對同一聊天也是依序推送）
+            for sequence in range(messages):
+                post(_selftest_update(user_id, sequence, user_id * messages + sequence, document_every))
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=16) as pool:
+            list(pool.map(send_user, range(1, users + 1)))
+
+        total = users * messages
+        try:
+            for _ in range(total):
+                received.append(results.get(timeout=30))
+        except Exception:
+            print(f"❌ 等待結果逾時：收到 {len(received)}/{total} 則")
+        elapsed = time.perf_counter() - started
+    finally:
+        router.close(shutdown_workers=True)
+        if server is not None:
+            server.shutdown()
+        stop_workers(processes, timeout=30)
+
+    pids_by_user = {}
+    per_worker = {}
+    failed = 0
+    documents = 0
+    for key, _, pid, ok, kind in received:
+        pids_by_user.setdefault(key, set()).add(pid)
+        per_worker[pid] = per_worker.get(pid, 0) + 1
+        failed += 0 if ok else 1
+        documents += 1 if kind == "document" else 0
+    split_users = [key for key, pids in pids_by_user.items() if len(pids) > 1]
+
+    ok = not split_users and not failed and len(received) == total
+    print(f"{'✅' if ok else '❌'} 分片自我檢查：{workers} 個工作程序、{users} 位用戶、{total} 則 update"
+          f"（其中 {documents} 份文件），{elapsed:.2f} 秒（{total / elapsed:.0f} 則/秒）")
+    print(f"   每個工作程序處理數: {sorted(per_worker.values())}，跨分片用戶: {len(split_users)}，"
+          f"順序錯誤或擷取失敗: {failed}")
+    return ok
+
+
+if __name__ == "__main__":
+    if "--selftest" in sys.argv:
+        count = int(sys.argv[sys.argv.index("--workers") + 1]) if "--workers" in sys.argv else 4
+        sys.exit(0 if selftest(workers=count) else 1)
+    print("用法: python -m modules.sharding --selftest [--workers N]")
@@ -0,0 +1,60 @@
+import asyncio
+import time
+
+
+class StageGraph:
+    """依賴感知的非同步階段圖
+
+    每個階段是一個 async 函式，相依階段的結果以關鍵字參數傳入；沒有相依關係的階段會並行執行。
+    階段可設定逾時與預設值：逾時或失敗時使用預設值，不影響其他階段。
+    """
+
+    def __init__(self, name: str = "stages"):
+        self.name = name
+        self.timings = {}
+        self.failures = {}
+        self._stages = {}
+
+    def add(self, name: str, func, deps=(), timeout: float = None, default=None):
+        """註冊階段；func(**{dep: result}) 必須回傳 coroutine"""
+        for dep in deps:
+            if dep not in self._stages:
+                raise ValueError(f"階段 {name} 依賴尚未註冊的階段 {dep}")
+        self._stages[name] = (func, tuple(deps), timeout, default)
+        return self
+
+    async def _run_stage(self, name, tasks):
+        func, deps, timeout, default = self._stages[name]
+        dep_results = {dep: await tasks[dep] for dep in deps}
+        started = time.perf_counter()
+        try:
+            if timeout is None:
+                return await func(**dep_results)
+            return await asyncio.wait_for(func(**dep_results), timeout)
+        except asyncio.TimeoutError:
+            self.failures[name] = "timeout"
+            print(f"⚠️ {self.name} 階段 {name} 逾時（{timeout}s），使用預設值")
+            return default
+        except Exception as e:
+            self.failures[name] = str(e)
+            print(f"⚠️ {self.name} 階段 {name} 失敗，使用預設值: {e}")
+            return default
+        finally:
+            self.timings[name] = time.perf_counter() - started
+
+    async def run(self) -> dict:
+        """執行所有階段，回傳 {階段名稱: 結果}"""
+        tasks = {}
+        # 依註冊順序建立 Task（相依階段一定先註冊）
+        for name in self._stages:
+            tasks[name] = asyncio.ensure_future(self._run_stage(name, tasks))
+        try:
+            results = await asyncio.gather(*tasks.values())
+        except BaseException:
+            for task in tasks.values():
+                task.cancel()
+            raise
+        return dict(zip(tasks.keys(), results))
+
+    def format_timings(self) -> str:
+        return ", ".join(f"{name}={seconds * 1000:.0f}ms" for name, seconds in self.timings.items())
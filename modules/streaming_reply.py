@@ -0,0 +1,94 @@
+import os
+import time
+import asyncio
+from telegram.error import BadRequest, RetryAfter
+
+# 串流回覆設定：兩次編輯的最短間隔（秒）與最少新增字數
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.2"))
+STREAM_EDIT_MIN_CHARS = int(os.getenv("STREAM_EDIT_MIN_CHARS", "20"))
+# Telegram 單則訊息長度上限
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+SENTENCE_ENDINGS = "。！？!?.\n～~"
+
+
+class StreamingReply:
+    """把逐步產生的文字以「先送出、再節流編輯」的方式呈現在 Telegram
+
+    第一句完成時送出訊息，之後依 STREAM_EDIT_INTERVAL 節流編輯同一則訊息；
+    finish() 時寫入完整文字，超過單則上限的部分以新訊息補送。
+    """
+
+    def __init__(self, message, interval: float = STREAM_EDIT_INTERVAL, min_chars: int = STREAM_EDIT_MIN_CHARS):
+        self.message = message
+        self.interval = interval
+        self.min_chars = min_chars
+        self.text = ""
+        self.sent = None  # 已送出的 Telegram 訊息
+        self.shown = ""  # 目前畫面上顯示的文字
+        self.edits = 0
+        self.first_sent_at = None
+        self._started = time.perf_counter()
+        self._next_edit_at = 0.0
+
+    async def feed(self, delta: str):
+        """加入新產生的文字片段"""
+        if not delta:
+            return
+        self.text += delta
+        if self.sent is None:
+            if any(ch in SENTENCE_ENDINGS for ch in delta):
+                await self._send(self.text.strip())
+            return
+
+        if len(self.text) - len(self.shown) >= self.min_chars and time.monotonic() >= self._next_edit_at:
+            await self._edit(self.text[:TELEGRAM_MESSAGE_LIMIT])
+
+    async def finish(self, final_text: str):
+        """寫入最終文字（可能與串流內容不同，例如附加表情或錯誤訊息）"""
+        head, rest = final_text[:TELEGRAM_MESSAGE_LIMIT], final_text[TELEGRAM_MESSAGE_LIMIT:]
+        if self.sent is None:
+            await self._send(head)
+        elif head != self.shown:
+            # 最後一次編輯不可略過：遇到限流就等待後重試
+            await self._edit(head, wait=True)
+
+        while rest:
+            await self.message.reply_text(rest[:TELEGRAM_MESSAGE_LIMIT])
+            rest = rest[TELEGRAM_MESSAGE_LIMIT:]
+
+    async def _send(self, text: str):
+        text = text[:TELEGRAM_MESSAGE_LIMIT]
+        if not text:
+            return
+        self.sent = await self.message.reply_text(text)
+        self.shown = text
+        self.first_sent_at = time.perf_counter() - self._started
+        self._next_edit_at = time.monotonic() + self.interval
+
+    async def _edit(self, text: str, wait: bool = False):
+        for _ in range(3):
+            try:
+                await self.sent.edit_text(text)
+                self.shown = text
+                self.edits += 1
+                self._next_edit_at = time.monotonic() + self.interval
+                return
+            except RetryAfter as e:
+                self._next_edit_at = time.monotonic() + e.retry_after
+                if not wait:
+                    return
+                await asyncio.sleep(e.retry_after)
+            except BadRequest as e:
+                # 內容未變更等情況不影響結果
+                if "not modified" in str(e).lower():
+                    self.shown = text
+                    return
+                raise
+
+    def stats(self) -> dict:
+        return {
+            "first_sent": round(self.first_sent_at, 3) if self.first_sent_at is not None else None,
+            "edits": self.edits,
+            "chars": len(self.text)
+        }
@@ -0,0 +1,165 @@
+import io
+import os
+import time
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+# 文件文字擷取設定：字數上限、檔案大小上限、每個檔案的時間上限與子程序數
+EXTRACT_MAX_CHARS = int(os.getenv("EXTRACT_MAX_CHARS", "10000"))
+EXTRACT_MAX_FILE_BYTES = int(os.getenv("EXTRACT_MAX_FILE_BYTES", str(20 * 1024 * 1024)))
+EXTRACT_TIMEOUT = float(os.getenv("EXTRACT_TIMEOUT", "20"))
+EXTRACT_MAX_WORKERS = int(os.getenv("EXTRACT_MAX_WORKERS", "2"))
+# 子程序超過時間上限仍未回應時，再多等的秒數，之後強制結束子程序
+EXTRACT_KILL_GRACE = 5.0
+
+# 每個擷取工作獨佔一個單一子程序的程序池：逾時時只強制結束該子程序，不影響其他正在進行的擷取
+_idle_pools = []  # 閒置中、可重複使用的程序池（最多 EXTRACT_MAX_WORKERS 個）
+_busy_pools = set()
+_slots = None  # 限制同時進行的擷取數
+
+
+class ExtractionError(Exception):
+    """文件無法擷取（超過大小上限、逾時等）"""
+
+
+def _open_binary(source):
+    """source 為檔案路徑或記憶體中的 bytes"""
+    return open(source, "rb") if isinstance(source, str) else io.BytesIO(source)
+
+
+def _iter_pdf(source):
+    import PyPDF2
+    with _open_binary(source) as f:
+        reader = PyPDF2.PdfReader(f)
+        for page in reader.pages:
+            yield page.extract_text() or ""  # 處理空頁
+
+
+def _iter_docx(source):
+    from docx import Document
+    with _open_binary(source) as f:
+        for para in Document(f).paragraphs:
+            yield para.text + "\n"
+
+
+def _iter_text(source, chunk_size=8192):
+    with io.TextIOWrapper(_open_binary(source), encoding="utf-8") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+
+def extract_text_sync(source, file_ext: str, max_chars: int = EXTRACT_MAX_CHARS,
+                      time_limit: float = EXTRACT_TIMEOUT) -> dict:
+    """逐頁／逐段擷取文字，達到字數上限或時間上限就停止（在子程序中執行）
+
+    source 為檔案路徑或 bytes。
+    """
+    deadline = time.monotonic() + time_limit
+    if file_ext == ".pdf":
+        pieces = _iter_pdf(source)
+    elif file_ext == ".docx":
+        pieces = _iter_docx(source)
+    else:
+        pieces = _iter_text(source)
+
+    parts = []
+    length = 0
+    units = 0
+    truncated = False
+    timed_out = False
+    for piece in pieces:
+        parts.append(piece)
+        length += len(piece)
+        units += 1
+        if length >= max_chars:
+            truncated = True
+            break
+        if time.monotonic() >= deadline:
+            timed_out = True
+            break
+    pieces.close()
+
+    return {
+        "text": "".join(parts)[:max_chars],
+        "units": units,
+        "truncated": truncated,
+        "timed_out": timed_out
+    }
+
+
+def _acquire_pool() -> ProcessPoolExecutor:
+    """取出一個閒置的單一子程序池（沒有時建立）；使用 spawn 避免複製主程序的執行緒狀態"""
+    pool = _idle_pools.pop() if _idle_pools else ProcessPoolExecutor(
+        max_workers=1, mp_context=multiprocessing.get_context("spawn"))
+    _busy_pools.add(pool)
+    return pool
+
+
+def _release_pool(pool: ProcessPoolExecutor):
+    """擷取完成後放回閒置池，超過上限的直接關閉"""
+    _busy_pools.discard(pool)
+    if len(_idle_pools) < EXTRACT_MAX_WORKERS:
+        _idle_pools.append(pool)
+    else:
+        pool.shutdown(wait=False)
+
+
+def _kill_pool(pool: ProcessPoolExecutor):
+    """強制結束卡住的子程序並捨棄它所屬的程序池（只影響這一個擷取工作）"""
+    _busy_pools.discard(pool)
+    for process in list(getattr(pool, "_processes", {}).values()):
+        process.kill()
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+async def extract_text(source, file_ext: str, max_chars: int = EXTRACT_MAX_CHARS,
+                       time_limit: float = EXTRACT_TIMEOUT) -> dict:
+    """在子程序中擷取文件文字，不佔用事件循環
+
+    source 為檔案路徑或記憶體中的 bytes（bytes 會經由管道傳給子程序，不落地）。
+    回傳 {"text", "units", "truncated", "timed_out"}；檔案過大或子程序無回應時拋出 ExtractionError。
+    """
+    size = os.path.getsize(source) if isinstance(source, str) else len(source)
+    if size > EXTRACT_MAX_FILE_BYTES:
+        raise ExtractionError(f"檔案過大（{size / 1024 / 1024:.1f}MB，上限 {EXTRACT_MAX_FILE_BYTES / 1024 / 1024:.0f}MB）")
+
+    global _slots
+    if _slots is None:
+        _slots = asyncio.Semaphore(EXTRACT_MAX_WORKERS)
+
+    loop = asyncio.get_running_loop()
+    async with _slots:
+        pool = _acquire_pool()
+        try:
+            future = loop.run_in_executor(pool, extract_text_sync, source, file_ext, max_chars, time_limit)
+            # 擷取本身會在 time_limit 內自行停止；單一頁面卡住時才會走到強制結束
+            result = await asyncio.wait_for(future, time_limit + EXTRACT_KILL_GRACE)
+        except asyncio.TimeoutError:
+            _kill_pool(pool)
+            raise ExtractionError(f"文件擷取逾時（超過 {time_limit:.0f} 秒）")
+        except BrokenProcessPool:
+            _kill_pool(pool)
+            raise ExtractionError("文件擷取子程序異常結束")
+        except BaseException:
+            # 被取消等情況：子程序可能仍在執行，不放回閒置池
+            _kill_pool(pool)
+            raise
+        _release_pool(pool)
+        return result
+
+
+def shutdown_extraction_pool():
+    """關閉所有程序池：閒置的等待子程序結束，仍在執行的強制結束
+
+    不等待閒置子程序結束時，在分片工作程序中結束會卡在 multiprocessing 等待子程序的步驟。
+    """
+    for pool in list(_busy_pools):
+        _kill_pool(pool)
+    for pool in _idle_pools:
+        pool.shutdown(wait=True)
+    _idle_pools.clear()
@@ -0,0 +1,67 @@
+from collections import deque
+
+
+class AhoCorasick:
+    """Aho-Corasick 多關鍵詞自動機：一次掃描文字即可找出所有出現的關鍵詞"""
+
+    def __init__(self, words):
+        self.words = []
+        self._word_ids = {}
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [()]
+
+        for word in words:
+            self.add_word(word)
+        self._build()
+
+    def add_word(self, word: str) -> int:
+        """加入關鍵詞，回傳其編號（重複的詞共用同一編號）"""
+        if word in self._word_ids:
+            return self._word_ids[word]
+
+        word_id = len(self.words)
+        self.words.append(word)
+        self._word_ids[word] = word_id
+
+        state = 0
+        for char in word:
+            next_state = self._goto[state].get(char)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append(())
+                self._goto[state][char] = next_state
+            state = next_state
+        self._output[state] = self._output[state] + (word_id,)
+        return word_id
+
+    def _build(self):
+        """以 BFS 建立失敗指標並合併輸出"""
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(char, 0)
+                self._output[next_state] = self._output[next_state] + self._output[self._fail[next_state]]
+
+    def word_id(self, word: str) -> int:
+        return self._word_ids[word]
+
+    def find_all(self, text: str) -> set:
+        """回傳文字中出現過的關鍵詞編號集合"""
+        goto, fail, output = self._goto, self._fail, self._output
+        found = set()
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state]:
+                found.update(output[state])
+        return found
@@ -0,0 +1,43 @@
+def cached_prompt_tokens(usage) -> int:
+    """從 API usage 取出命中 prompt 快取的 token 數（舊版 SDK 以 dict 形式保留額外欄位）"""
+    details = getattr(usage, "prompt_tokens_details", None)
+    if details is None:
+        return 0
+    if isinstance(details, dict):
+        return details.get("cached_tokens") or 0
+    return getattr(details, "cached_tokens", 0) or 0
+
+
+class PromptCacheStats:
+    """累計 chat completion 的 prompt token 與快取命中比例"""
+
+    def __init__(self):
+        self.requests = 0
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+        self.completion_tokens = 0
+
+    def record(self, usage) -> dict:
+        """記錄一次回應的 usage，回傳本次的統計（沒有 usage 時回傳 None）"""
+        if usage is None:
+            return None
+        prompt = getattr(usage, "prompt_tokens", 0) or 0
+        cached = cached_prompt_tokens(usage)
+        self.requests += 1
+        self.prompt_tokens += prompt
+        self.cached_tokens += cached
+        self.completion_tokens += getattr(usage, "completion_tokens", 0) or 0
+        return {
+            "prompt_tokens": prompt,
+            "cached_tokens": cached,
+            "cached_ratio": cached / prompt if prompt else 0.0
+        }
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "prompt_tokens": self.prompt_tokens,
+            "cached_tokens": self.cached_tokens,
+            "completion_tokens": self.completion_tokens,
+            "cached_ratio": self.cached_tokens / self.prompt_tokens if self.prompt_tokens else 0.0
+        }
@@ -0,0 +1,269 @@
+import os
+import re
+import json
+import threading
+import weakref
+import numpy as np
+from modules.ttl_cache import TTLCache
+from modules.executor import run_blocking
+
+# 本機向量索引設定
+VECTOR_INDEX_DIR = os.getenv("VECTOR_INDEX_DIR", os.path.join("data", "vector_index"))
+VECTOR_INDEX_MAX_OPEN = int(os.getenv("VECTOR_INDEX_MAX_OPEN", "256"))
+# 超過此筆數改用 IVF 近似搜尋（分群後只掃描最接近的幾群）
+VECTOR_INDEX_ANN_THRESHOLD = int(os.getenv("VECTOR_INDEX_ANN_THRESHOLD", "20000"))
+VECTOR_INDEX_ANN_PROBES = int(os.getenv("VECTOR_INDEX_ANN_PROBES", "8"))
+# 記住「已回填」狀態的分區數（未命中時改查分區目錄中的標記檔）
+VECTOR_INDEX_BACKFILLED_CACHE_SIZE = int(os.getenv("VECTOR_INDEX_BACKFILLED_CACHE_SIZE", "4096"))
+
+
+def _normalize(vector) -> np.ndarray:
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+
+class IVFIndex:
+    """簡易 IVF 近似索引：k-means 分群，查詢時只計算最接近的 n_probe 群"""
+
+    def __init__(self, matrix: np.ndarray, n_lists: int, iterations: int = 10, seed: int = 0):
+        rng = np.random.default_rng(seed)
+        sample = matrix[rng.choice(len(matrix), size=min(len(matrix), n_lists * 64), replace=False)]
+        centroids = sample[rng.choice(len(sample), size=n_lists, replace=False)].copy()
+        for _ in range(iterations):
+            assignment = np.argmax(sample @ centroids.T, axis=1)
+            for i in range(n_lists):
+                members = sample[assignment == i]
+                if len(members):
+                    centroids[i] = _normalize(members.mean(axis=0))
+        self.centroids = centroids
+        self.size = len(matrix)
+        assignment = np.empty(len(matrix), dtype=np.int32)
+        # 分批指派，避免一次產生過大的暫存矩陣
+        for start in range(0, len(matrix), 8192):
+            block = np.asarray(matrix[start:start + 8192])
+            assignment[start:start + 8192] = np.argmax(block @ centroids.T, axis=1)
+        self.lists = [np.flatnonzero(assignment == i) for i in range(n_lists)]
+
+    def candidates(self, query: np.ndarray, n_probe: int) -> np.ndarray:
+        nearest = np.argsort(-(self.centroids @ query))[:n_probe]
+        return np.concatenate([self.lists[i] for i in nearest])
+
+
+class NamespaceLock:
+    """分區寫檔用的鎖（threading.Lock 不支援弱引用，包一層才能放進 WeakValueDictionary）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        self._lock.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self._lock.release()
+
+
+class ConversationVectorIndex:
+    """單一對話的本機向量索引
+
+    向量（已正規化的 float32）依序寫入 vectors.f32 並以 memmap 讀取；
+    每列的內容以 JSON lines 寫入 meta.jsonl（同一 key 再次寫入會覆蓋原本那一列）。
+    """
+
+    def __init__(self, directory: str, lock: NamespaceLock = None):
+        self.directory = directory
+        self.vectors_path = os.path.join(directory, "vectors.f32")
+        self.meta_path = os.path.join(directory, "meta.jsonl")
+        self.dim = None
+        self.payloads = []
+        self.keys = {}
+        self.lock = lock or NamespaceLock()
+        self._matrix = None
+        self._ann = None
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.meta_path):
+            return
+        lines = 0
+        with open(self.meta_path, "r", encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # 寫到一半中斷的最後一行
+                    continue
+                lines += 1
+                if self.dim is None:
+                    self.dim = record.get("dim")
+                row = record["row"]
+                if row == len(self.payloads):
+                    self.payloads.append(record["payload"])
+                elif row < len(self.payloads):
+                    self.payloads[row] = record["payload"]
+                self.keys[record["key"]] = row
+        if not self.dim:
+            return
+
+        # 向量與 meta 以 meta 為準：向量檔較短時捨棄多出的 meta；
+        # 較長（寫入向量後、寫入 meta 前中斷，或只寫了半列）時截斷向量檔，之後新增的列才會對齊
+        size = os.path.getsize(self.vectors_path) if os.path.exists(self.vectors_path) else 0
+        rows = size // (self.dim * 4)
+        trimmed = rows < len(self.payloads)
+        if trimmed:
+            del self.payloads[rows:]
+            self.keys = {key: row for key, row in self.keys.items() if row < rows}
+        expected = len(self.payloads) * self.dim * 4
+        if size != expected:
+            with open(self.vectors_path, "r+b") as f:
+                f.truncate(expected)
+
+        # 覆寫同一 key 會在 meta 追加一行，累積太多時壓縮成每列一行
+        if trimmed or lines > 2 * len(self.payloads) + 100:
+            self._compact_meta()
+
+    def _compact_meta(self):
+        temp_path = f"{self.meta_path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            for key, row in sorted(self.keys.items(), key=lambda item: item[1]):
+                f.write(json.dumps({"key": key, "row": row, "dim": self.dim, "payload": self.payloads[row]},
+                                   ensure_ascii=False) + "\n")
+        os.replace(temp_path, self.meta_path)
+
+    def __len__(self):
+        return len(self.payloads)
+
+    def _append_meta(self, key, row, payload):
+        with open(self.meta_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps({"key": key, "row": row, "dim": self.dim, "payload": payload}, ensure_ascii=False) + "\n")
+
+    def add(self, key: str, embedding, payload: dict, replace: bool = True):
+        """新增或覆蓋一筆向量（replace=False 時已存在的 key 不覆蓋）"""
+        vector = _normalize(embedding)
+        with self.lock:
+            if not replace and key in self.keys:
+                return
+            if self.dim is None:
+                self.dim = len(vector)
+                os.makedirs(self.directory, exist_ok=True)
+            elif len(vector) != self.dim:
+                raise ValueError(f"向量維度不符：{len(vector)} != {self.dim}")
+
+            row = self.keys.get(key)
+            if row is None:
+                row = len(self.payloads)
+                with open(self.vectors_path, "ab") as f:
+                    f.write(vector.tobytes())
+                self.payloads.append(payload)
+            else:
+                with open(self.vectors_path, "r+b") as f:
+                    f.seek(row * self.dim * 4)
+                    f.write(vector.tobytes())
+                self.payloads[row] = payload
+            self.keys[key] = row
+            self._append_meta(key, row, payload)
+            self._matrix = None
+
+    def _get_matrix(self):
+        if self._matrix is None and self.payloads:
+            self._matrix = np.memmap(self.vectors_path, dtype=np.float32, mode="r",
+                                     shape=(len(self.payloads), self.dim))
+        return self._matrix
+
+    def search(self, embedding, k: int = 3) -> list:
+        """回傳最相似的 k 筆內容（附 similarity 分數）"""
+        with self.lock:
+            matrix = self._get_matrix()
+            if matrix is None:
+                return []
+            query = _normalize(embedding)
+            size = len(self.payloads)
+
+            if size >= VECTOR_INDEX_ANN_THRESHOLD:
+                # 索引成長一倍才重建分群；之後新增的列直接全掃
+                if self._ann is None or size >= self._ann.size * 2:
+                    self._ann = IVFIndex(matrix, n_lists=max(16, int(size ** 0.5)))
+                candidates = np.concatenate([
+                    self._ann.candidates(query, VECTOR_INDEX_ANN_PROBES),
+                    np.arange(self._ann.size, size)
+                ])
+                scores = np.asarray(matrix[candidates]) @ query
+            else:
+                candidates = None
+                scores = np.asarray(matrix) @ query
+
+            k = min(k, len(scores))
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+            results = []
+            for i in top:
+                row = int(candidates[i]) if candidates is not None else int(i)
+                results.append(dict(self.payloads[row], similarity=float(scores[i])))
+            return results
+
+
+class LocalVectorIndex:
+    """以 conversation_id 分區的本機向量索引集合（開啟中的索引以 LRU 管理）"""
+
+    def __init__(self, base_dir: str = VECTOR_INDEX_DIR, max_open: int = VECTOR_INDEX_MAX_OPEN):
+        self.base_dir = base_dir
+        self._open = TTLCache(maxsize=max_open)
+        self._lock = threading.Lock()
+        # 每個分區固定一把鎖：索引物件被 LRU 淘汰後重新開啟，也不會與仍在使用的舊物件同時寫檔；
+        # 鎖由索引物件持有，該分區的所有索引物件都釋放後自動移除
+        self._namespace_locks = weakref.WeakValueDictionary()
+        self._backfilled = TTLCache(maxsize=VECTOR_INDEX_BACKFILLED_CACHE_SIZE)
+
+    def _directory(self, namespace: str) -> str:
+        return os.path.join(self.base_dir, re.sub(r"[^0-9A-Za-z_-]", "_", namespace))
+
+    def is_backfilled(self, namespace: str) -> bool:
+        """是否已從資料庫回填過歷史資料"""
+        if self._backfilled.get(namespace):
+            return True
+        if os.path.exists(os.path.join(self._directory(namespace), "backfilled")):
+            self._backfilled.set(namespace, True)
+            return True
+        return False
+
+    def mark_backfilled(self, namespace: str):
+        directory = self._directory(namespace)
+        os.makedirs(directory, exist_ok=True)
+        open(os.path.join(directory, "backfilled"), "w").close()
+        self._backfilled.set(namespace, True)
+
+    def _get(self, namespace: str) -> ConversationVectorIndex:
+        with self._lock:
+            index = self._open.get(namespace)
+            if index is None:
+                lock = self._namespace_locks.get(namespace)
+                if lock is None:
+                    lock = NamespaceLock()
+                    self._namespace_locks[namespace] = lock
+                index = ConversationVectorIndex(self._directory(namespace), lock)
+                self._open.set(namespace, index)
+            return index
+
+    def add_many_sync(self, namespace: str, items, replace: bool = True):
+        """同步批次寫入 [(key, embedding, payload), ...]"""
+        index = self._get(namespace)
+        for key, embedding, payload in items:
+            index.add(key, embedding, payload, replace=replace)
+
+    async def add(self, namespace: str, key: str, embedding, payload: dict):
+        await run_blocking(self.add_many_sync, namespace, [(key, embedding, payload)])
+
+    async def add_many(self, namespace: str, items, replace: bool = True):
+        await run_blocking(self.add_many_sync, namespace, list(items), replace)
+
+    async def search(self, namespace: str, embedding, k: int = 3) -> list:
+        return await run_blocking(lambda: self._get(namespace).search(embedding, k))
+
+    async def contains(self, namespace: str, key: str) -> bool:
+        return await run_blocking(lambda: key in self._get(namespace).keys)
+
+    async def size(self, namespace: str) -> int:
+        return await run_blocking(lambda: len(self._get(namespace)))
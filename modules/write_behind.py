@@ -0,0 +1,85 @@
+import asyncio
+
+
+class WriteBehindBuffer:
+    """延遲寫入緩衝：先標記髒資料，再定時或在累積到一定數量時批次寫回
+
+    同一個 key 在兩次刷新之間被標記多次，只會寫入最後的狀態一次。
+    flush_func 為 async 函式，接收 [(key, obj), ...] 串列。
+    """
+
+    def __init__(self, flush_func, interval: float = 10.0, max_dirty: int = 50, name: str = "write-behind"):
+        self.flush_func = flush_func
+        self.interval = interval
+        self.max_dirty = max_dirty
+        self.name = name
+        self.flush_count = 0
+        self.items_flushed = 0
+        self.failures = 0
+        self._dirty = {}
+        self._lock = asyncio.Lock()
+        self._task = None
+        self._pending_flush = None
+
+    def mark_dirty(self, key, obj):
+        """標記需要寫回的物件；達到數量上限時立即安排一次刷新"""
+        self._dirty[key] = obj
+        if len(self._dirty) >= self.max_dirty and (self._pending_flush is None or self._pending_flush.done()):
+            self._pending_flush = asyncio.ensure_future(self.flush())
+
+    def is_dirty(self, key) -> bool:
+        return key in self._dirty
+
+    def pending(self, key):
+        """取得尚未寫回的物件（沒有則回傳 None）"""
+        return self._dirty.get(key)
+
+    async def flush(self) -> int:
+        """立即寫回所有髒資料，回傳寫入數量"""
+        async with self._lock:
+            if not self._dirty:
+                return 0
+            items = self._dirty
+            self._dirty = {}
+            try:
+                await self.flush_func(list(items.items()))
+            except Exception as e:
+                self.failures += 1
+                # 寫入失敗：放回緩衝等待下次刷新（期間若有更新則以新的為準）
+                for key, obj in items.items():
+                    self._dirty.setdefault(key, obj)
+                print(f"❌ {self.name} 批次寫入失敗（{len(items)} 筆，稍後重試）: {e}")
+                return 0
+
+            self.flush_count += 1
+            self.items_flushed += len(items)
+            return len(items)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    def start(self):
+        """啟動定時刷新（需在事件循環中呼叫）"""
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        """停止定時刷新並寫回剩餘資料"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self._dirty),
+            "flushes": self.flush_count,
+            "items_flushed": self.items_flushed,
+            "failures": self.failures
+        }
@@ -0,0 +1,73 @@
+-- 對話記憶的單一語句 upsert
+-- 在 Supabase SQL Editor 執行一次即可；資料表名稱若有透過 SUPABASE_MEMORIES_TABLE 修改，請一併替換。
+
+-- 1. 使用者訊息的內容雜湊（與 bot.py 的 message_hash() 相同：sha256 hex）
+alter table xiaochenguang_memories add column if not exists message_hash text;
+
+update xiaochenguang_memories
+set message_hash = encode(sha256(convert_to(user_message, 'UTF8')), 'hex')
+where memory_type = 'conversation' and message_hash is null and user_message is not null;
+
+-- 2. 合併既有的重複記憶：保留最新一筆，access_count 加總
+with ranked as (
+    select id,
+           row_number() over (partition by conversation_id, memory_type, message_hash
+                              order by created_at desc, id desc) as rn,
+           sum(access_count) over (partition by conversation_id, memory_type, message_hash) as total
+    from xiaochenguang_memories
+    where memory_type = 'conversation' and message_hash is not null
+)
+update xiaochenguang_memories m
+set access_count = ranked.total
+from ranked
+where m.id = ranked.id and ranked.rn = 1;
+
+with ranked as (
+    select id,
+           row_number() over (partition by conversation_id, memory_type, message_hash
+                              order by created_at desc, id desc) as rn
+    from xiaochenguang_memories
+    where memory_type = 'conversation' and message_hash is not null
+)
+delete from xiaochenguang_memories m
+using ranked
+where m.id = ranked.id and ranked.rn > 1;
+
+-- 3. 衝突鍵
+create unique index if not exists xiaochenguang_memories_conversation_hash_key
+    on xiaochenguang_memories (conversation_id, memory_type, message_hash)
+    where memory_type = 'conversation';
+
+-- 4. 批次 upsert：rows 為 JSON 陣列，每筆含 hits（本批出現次數），access_count 在資料庫端累加
+--    回傳 [{conversation_id, message_hash, access_count}, ...]
+create or replace function upsert_memories(rows jsonb)
+returns jsonb
+language sql
+as $$
+    with upserted as (
+        insert into xiaochenguang_memories as m
+            (conversation_id, user_message, assistant_message, embedding, memory_type, platform,
+             document_content, created_at, access_count, importance_score, message_hash)
+        select r.conversation_id, r.user_message, r.assistant_message, r.embedding::text::vector, 'conversation',
+               r.platform, r.document_content, r.created_at, r.hits, r.importance_score, r.message_hash
+        from jsonb_to_recordset(rows) as r(
+            conversation_id text, user_message text, assistant_message text, embedding jsonb, platform text,
+            document_content text, created_at timestamptz, hits int, importance_score float8, message_hash text
+        )
+        on conflict (conversation_id, memory_type, message_hash) where memory_type = 'conversation'
+        do update set
+            assistant_message = excluded.assistant_message,
+            embedding = excluded.embedding,
+            document_content = excluded.document_content,
+            created_at = excluded.created_at,
+            importance_score = excluded.importance_score,
+            access_count = m.access_count + excluded.access_count
+        returning m.conversation_id, m.message_hash, m.access_count
+    )
+    select coalesce(jsonb_agg(jsonb_build_object(
+        'conversation_id', conversation_id,
+        'message_hash', message_hash,
+        'access_count', access_count
+    )), '[]'::jsonb)
+    from upserted;
+$$;